@@ -1,17 +1,44 @@
 import argparse
+import bisect
+import grp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 import logging
 import logging.handlers
+import multiprocessing
 import os
+import pwd
+import re
+import stat
 import subprocess
-import sys
 import tarfile
+import threading
+import time
 
-from common import convert_tgmk, get_filename_range_descriptor, get_smtp_handler, get_temp_file_name, get_size, report
+from catalog import Catalog
+from checksums import record_checksum
+from common import convert_tgmk, copy_stream, get_dotted_name, get_file_hash, get_filename_range_descriptor, \
+    get_prehash, get_smtp_handler, get_temp_file_name, HashingReader, HashingWriter, report
+from compressor import DEFAULT_BLOCK_SIZE, get_compress_command
+from encrypter import get_encrypt_command
+from ledger import get_free_space, get_usage
+from manifest import Manifest
+from metrics import get_record, StageTimer
+from prefetch import get_tar_order, Prefetcher, READ_ORDERS
+from scanner import DirectoryScanner, get_tar_size, SizeLookahead
+from size_index import SizeIndex
+from traversal import Traversal
+from uploader import BUCKET, check_not_uploaded, upload_stream
 
 
-# Specify the slowest expected speed for a du command
-DU_MIN_BYTES_PER_SEC = convert_tgmk("500M")
+# Files smaller than this are not worth checking for copies
+DEDUP_MIN_SIZE = 2**20
+
+# Number of archives worth of items looked at when planning an archive's contents
+PLAN_ARCHIVES = 4
+
+# A copy of the catalog is sent through the pipeline at the end of every pass and at least this often
+CATALOG_DAYS = 30
 
 parser = argparse.ArgumentParser(description='Create alphabetical archive volumes of a directory.')
 parser.add_argument('source', type=os.path.abspath, help='path to be archived')
@@ -24,9 +51,41 @@ parser.add_argument('-c', '--checkpoint', type=os.path.abspath, default=None,
                     help='continue an archive process that last archived this path')
 parser.add_argument('-s', '--stop', default='100T', type=convert_tgmk,
                     help='maximum size of an destination directory (K, M, G, P supported)')
+parser.add_argument('--scan-threads', default=16, type=int,
+                    help='threads to use when calculating directory sizes')
+parser.add_argument('--lookahead', default=4, type=int,
+                    help='number of entries after the one being archived whose sizes are calculated in the background, '
+                         '0 to calculate each size only when it is needed')
+parser.add_argument('--stream', action='store_true',
+                    help='compress, encrypt and upload each archive as it is written instead of staging it')
+parser.add_argument('-t', '--threads', default=1, type=int, help='threads to use for compression with --stream')
+parser.add_argument('--bucket', default=BUCKET,
+                    help='upload destination with --stream, an S3 url or a local directory')
 parser.add_argument('-d', '--debug', action='store_true', help='enable debug logging')
+parser.add_argument('-i', '--incremental', action='store_true',
+                    help='once everything has been archived, start again archiving only new and changed files')
+parser.add_argument('--min-fill', default=0.5, type=float,
+                    help='fraction of --max-size below which archives are evened out with their neighbours')
+parser.add_argument('--dedup', action='store_true',
+                    help='leave out files whose content is already archived, recording them in the manifest')
+parser.add_argument('--read-order', default=None, choices=READ_ORDERS,
+                    help='read the files of each archive ahead of tar in inode or physical disk order')
+parser.add_argument('--read-ahead', default='256M', type=convert_tgmk,
+                    help='how far ahead of tar to read with --read-order (K, M, G, P supported)')
+parser.add_argument('--partitions', default=None,
+                    help='archive disjoint subtrees of the source at once, each with its own worker, checkpoint and '
+                         'size index: mounts for the mount points below the source, top for its top level '
+                         'directories, or a comma separated list of paths')
+parser.set_defaults(handoff=None, manifest=None, catalog=None, checkpoint_part=None, partition=None, exclude=[],
+                    workers=1, pass_finished=False)
 
-size_cache = {}
+# Sizes are remembered in memory unless main points this at the working directory
+size_index = SizeIndex(":memory:")
+
+# Listings of the directories from the source down to the one last archived, so the next archive finds its way
+# back without listing them again, along with the stats of their entries
+# They are kept in memory unless main points this at the working directory, which keeps them for the next run too
+traversal = Traversal()
 
 
 def main():
@@ -36,6 +95,26 @@ def main():
     args.destination = str(args.destination)
     args.temp = str(args.temp)
 
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.getLogger().addHandler(get_smtp_handler())
+
+    try:
+        if args.partitions:
+            run_partitions(args)
+        else:
+            run(args)
+    except Exception as e:
+        logging.exception('Unhandled Exception', exc_info=e)
+        exit(1)
+
+
+# Create archives from the checkpoint until the working directory is full or everything has been archived
+# Returns True once everything has been archived
+def run(args):
+    global size_index, traversal
+
     # Verify and create any directories we might need
     assert os.path.isdir(args.working_dir)
     path = os.path.join(args.working_dir, args.destination)
@@ -44,181 +123,780 @@ def main():
     path = os.path.join(args.working_dir, args.temp)
     if not os.path.exists(path):
         os.makedirs(path)
-    checkpoint_path = os.path.join(args.working_dir, "checkpoint.txt")
+    path = get_state_path(args, "")
+    if not os.path.exists(path):
+        os.makedirs(path)
+    checkpoint_path = get_state_path(args, "checkpoint.txt")
 
-    if args.debug:
-        logging.basicConfig(level=logging.DEBUG)
-    else:
-        logging.getLogger().addHandler(get_smtp_handler())
+    # Partitions leave this to the process running them, as the others are already writing their archives
+    if args.workers == 1:
+        remove_partial_archives(args)
 
     # Try to load a checkpoint if one was not specified
     if not args.checkpoint:
         if os.path.exists(checkpoint_path):
             with open(checkpoint_path, 'r') as f:
-                args.checkpoint = f.read().rstrip()
-            if args.checkpoint == "EOF":
-                logging.debug(f"Archiver previously archived all files. Exiting.")
-                exit(0)
+                lines = f.read().splitlines()
+
+            # A second line is the number of volumes written of a file split across archives
+            args.checkpoint = lines[0]
+            if len(lines) > 1:
+                args.checkpoint_part = int(lines[1])
             logging.debug(f"Archiver found previous checkpoint to be {args.checkpoint}.")
 
-    try:
-        logging.debug(f"archiver starting")
-        while True:
+    # Every walk through the source is a pass recorded in the manifest
+    if args.manifest is None:
+        args.manifest = Manifest(get_state_path(args, "manifest.sqlite"))
+    if args.catalog is None:
+        args.catalog = Catalog(os.path.join(args.working_dir, "catalog.sqlite"))
+    if args.manifest.number is None:
+        if args.checkpoint != "EOF":
+            args.manifest.start_pass(incremental=False)
+        elif args.incremental:
+            logging.debug(f"Archiver starting an incremental pass.")
+            args.manifest.start_pass(incremental=True)
+            args.checkpoint = None
+            os.remove(checkpoint_path)
 
-            # Check if we should continue
-            size = get_size(args.working_dir)
-            if size > args.stop:
-                logging.debug("Archiver terminating as working_dir size limit has been reached.")
-                break
+    # Finish a pass that reached the end just before the last run stopped
+    elif args.checkpoint == "EOF":
+        finish_pass(args)
+    if args.checkpoint == "EOF":
+        logging.debug(f"Archiver previously archived all files. Exiting.")
+        return True
 
-            # Create the next archive from the checkpoint
-            if not archive_directory(args, args.source):
+    # Keep directory sizes between runs, dropping any for paths already archived
+    index_path = get_state_path(args, "size_index.sqlite")
+    if size_index.path != index_path:
+        size_index = SizeIndex(index_path)
+    if args.checkpoint:
+        size_index.evict(args.checkpoint)
 
-                # If we get through the entire directory, checkpoint the end offile
-                logging.debug("Archiver terminating as it found nothing to backup.")
-                with open(checkpoint_path, 'w') as f:
-                    f.write(f"EOF\n")
-                break
+    # Keep the listings on the way to the checkpoint between runs as well
+    listings_path = get_state_path(args, "listings.sqlite")
+    if traversal.path != listings_path:
+        traversal = Traversal(listings_path)
+
+    logging.debug(f"archiver starting")
+    while True:
 
-            # Save this spot as a checkpoint
+        # Check if we should continue
+        size = get_usage(args.working_dir)
+        if size > args.stop:
+            logging.debug("Archiver terminating as working_dir size limit has been reached.")
+            break
+        if not args.stream and get_free_space(args.working_dir) < args.max_size * args.workers:
+            logging.debug("Archiver terminating as working_dir does not have room for another archive.")
+            break
+
+        # Create the next archive from the checkpoint
+        if not archive_directory(args, args.source):
+
+            # If we get through the entire directory, checkpoint the end offile
+            logging.debug("Archiver terminating as it found nothing to backup.")
             with open(checkpoint_path, 'w') as f:
-                f.write(f"{args.checkpoint}\n")
+                f.write(f"EOF\n")
+            args.checkpoint = "EOF"
+            finish_pass(args)
+            break
+
+        # Save this spot as a checkpoint
+        with open(checkpoint_path, 'w') as f:
+            f.write(f"{args.checkpoint}\n")
+            if args.checkpoint_part is not None:
+                f.write(f"{args.checkpoint_part}\n")
+        size_index.evict(args.checkpoint)
+        traversal.save(args.checkpoint)
+
+    if args.workers == 1 and args.checkpoint != "EOF" and args.catalog.is_due(CATALOG_DAYS):
+        ship_catalog(args, args.catalog)
+    logging.debug(f"archiver ending")
+    return args.checkpoint == "EOF"
+
+
+# Archive each partition of the source in a process of its own, all sharing the working directory and its --stop
+# The source itself is a partition too, leaving out the others, so everything is archived by exactly one worker
+# Returns True once every partition has been archived
+def run_partitions(args):
+    remove_partial_archives(args)
+    partitions = get_partitions(args)
+    logging.debug(f"archiver partitions {', '.join(partitions)}")
+    workers = []
+    for partition in [args.source] + partitions:
+        worker_args = argparse.Namespace(**vars(args))
+        worker_args.source = partition
+        worker_args.partitions = None
+        worker_args.partition = None if partition == args.source else partition
+        worker_args.exclude = [x for x in partitions if x.startswith(os.path.join(partition, ''))]
+        worker_args.workers = len(partitions) + 1
+        # Each worker opens its own manifest and catalog
+        worker_args.manifest = None
+        worker_args.catalog = None
+        workers.append(worker_args)
+
+    # Archives are handed off through a queue, as whatever takes them lives in this process
+    context = multiprocessing.get_context('spawn')
+    manager = None
+    if args.handoff is not None:
+        manager = context.Manager()
+        handoffs = manager.Queue()
+        for worker_args in workers:
+            worker_args.handoff = handoffs.put
+        forward = threading.Thread(target=forward_handoffs, args=(handoffs, args.handoff), daemon=True)
+        forward.start()
+
+    try:
+        with ProcessPoolExecutor(max_workers=len(workers), mp_context=context) as pool:
+            futures = [pool.submit(run_partition, x) for x in workers]
+            results = [x.result() for x in futures]
+    finally:
+        if manager is not None:
+            handoffs.put(None)
+            forward.join()
+            manager.shutdown()
+
+    # The catalog covers the whole source once the last partition finishes its pass
+    # It is opened only for as long as it takes, as args are handed to the workers again on the next call
+    finished = all(x[0] for x in results)
+    catalog = Catalog(os.path.join(args.working_dir, "catalog.sqlite"))
+    try:
+        if finished and any(x[1] for x in results) or catalog.is_due(CATALOG_DAYS):
+            ship_catalog(args, catalog)
+    finally:
+        catalog.close()
+    return finished
+
+
+# Run one partition in a worker process, logging as the main process does
+# Returns whether everything in the partition has been archived and whether a pass finished in this run
+def run_partition(args):
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG, format=f"%(levelname)s:{get_dotted_name(args.source)}:%(message)s")
+    return run(args), args.pass_finished
+
+
+def forward_handoffs(handoffs, handoff):
+    while True:
+        path = handoffs.get()
+        if path is None:
+            return
+        handoff(path)
+
+
+# Return the roots of the partitions below the source, which are the mount points below it, its top level
+# directories, or the paths listed, leaving out the working directory
+def get_partitions(args):
+    prefix = os.path.join(args.source, '')
+    if args.partitions == 'mounts':
+        partitions = [x for x in get_mount_points() if x.startswith(prefix)]
+    elif args.partitions == 'top':
+        with os.scandir(args.source) as entries:
+            partitions = [x.path for x in entries if x.is_dir(follow_symlinks=False)]
+    else:
+        partitions = [os.path.abspath(x) for x in args.partitions.split(',')]
+        for partition in partitions:
+            if not partition.startswith(prefix) or not os.path.isdir(partition):
+                raise ValueError(f"partition {partition} is not a directory below {args.source}")
+    return sorted({x for x in partitions if x != args.working_dir})
 
-        logging.debug(f"archiver ending")
-    except Exception as e:
-        logging.exception('Unhandled Exception', exc_info=e)
-        exit(1)
+
+# Mount points from the kernel's mount table, in which spaces and other special characters are octal escapes
+def get_mount_points():
+    with open("/proc/self/mounts", 'r') as f:
+        return [re.sub(r"\\([0-7]{3})", lambda x: chr(int(x.group(1), 8)), line.split()[1]) for line in f]
+
+
+# Each partition keeps its state in a folder of its own, and the source keeps it where it did before partitioning
+def get_state_path(args, name):
+    if args.partition is None:
+        return os.path.join(args.working_dir, name)
+    return os.path.join(args.working_dir, "partitions", get_dotted_name(args.partition), name)
+
+
+# Remove any partial archives left behind by a crashed run
+def remove_partial_archives(args):
+    path = os.path.join(args.working_dir, args.temp)
+    if not os.path.isdir(path):
+        return
+    for listing in os.listdir(path):
+        if re.fullmatch(r"tmp[A-Za-z0-9]{16}\.tar", listing):
+            os.remove(os.path.join(path, listing))
 
 
 # Function returns True when it has successfully created the next archive file
 def archive_directory(args, dir_path):
     logging.debug(f"Starting archive of directory {dir_path}")
-    archive = Archive(args.working_dir, dir_path, args.max_size)
+    timer = StageTimer('archive')
+    if args.stream:
+        archive = StreamArchive(args.working_dir, dir_path, args.max_size, args.threads, args.bucket, args.manifest,
+                                args.dedup)
+    else:
+        archive = Archive(args.working_dir, dir_path, args.max_size, args.manifest, args.dedup)
+    if args.read_order is not None:
+        archive.prefetcher = Prefetcher(args.read_order, args.read_ahead)
 
-    # Get the directory listing in alphabetical order
-    directory_list = os.listdir(dir_path)
-    directory_list.sort()
+    # Directories coming up are measured in the background while the current item is written, sharing the scan
+    # threads between them. Changes in an incremental pass are measured against the manifest, so only as needed.
+    depth = 0 if args.manifest.incremental else args.lookahead
+    lookahead = SizeLookahead(depth, args.max_size, max(1, args.scan_threads // max(1, depth)), record_size)
+    with archive, lookahead:
 
-    # Run through the contents of this directory
-    for listing in directory_list:
+        # Get the directory listing in alphabetical order
+        directory_list = traversal.list(dir_path)
+        syscalls = traversal.syscalls
 
-        path = os.path.join(dir_path, listing)
+        # If we have a checkpoint below this directory, find its name here and skip ahead to it
+        start = 0
+        name = get_checkpoint_name(args.checkpoint, dir_path)
+        if name is not None:
+            start = bisect.bisect_left(directory_list, name)
+            path = os.path.join(dir_path, name)
+            if start < len(directory_list) and directory_list[start] == name:
+                # If we are on the path of the checkpoint, go into the next directory
+                if path != args.checkpoint:
+                    if traversal.is_dir(path) and archive_directory(args, path):
+                        return True
+                    start += 1
+                # If we have caught up to the last archive, one more skip, unless it is a file part way through volumes
+                elif args.checkpoint_part is None:
+                    start += 1
 
-        if path == args.working_dir:
-            logging.warning(f"Ignoring directory {path} so archiver does not archive itself")
-            return False
+        # Run through the contents of this directory
+        changed_sizes = {}
+        plan_end = len(directory_list)
+        for index in range(start, len(directory_list)):
+
+            listing = directory_list[index]
+            path = os.path.join(dir_path, listing)
 
-        # If we have a checkpoint, see if we should skip ahead
-        if args.checkpoint:
-            # If we have caught up to the last archive, one more skip
-            if path == args.checkpoint:
+            if path == args.working_dir:
+                logging.warning(f"Ignoring directory {path} so archiver does not archive itself")
+                return False
+
+            # Partitions below this one are archived by their own workers
+            if path in args.exclude:
                 continue
-            # If we are on the path of the checkpoint, go into the next directory
-            if path + "/" in args.checkpoint:
-                if os.path.isdir(path):
-                    if archive_directory(args, path):
-                        return True
+
+            look_ahead(args, lookahead, dir_path, directory_list[index + 1:index + 1 + depth])
+
+            # Plan how far this archive should go when it is about to get its first item
+            if archive.size == 0:
+                plan_end = plan_archive(args, dir_path, directory_list, index, changed_sizes, lookahead)
+            elif index >= plan_end:
+                logging.debug(f"{archive} is closing at {path} as planned")
+                break
+
+            # This size calculation could be slow, so pass the threshold value
+            size = get_item_size(args, path, args.max_size - archive.size, changed_sizes, lookahead)
+            if args.manifest.incremental and size == 0:
+                logging.debug(f"{path} has not changed")
                 continue
-            # If we are alphabetically earlier than the checkpint, skip ahead
-            if args.checkpoint > path:
+            logging.debug(f"size of {path} is >= {size}")
+
+            # If this item won't fit into the current archive
+            if archive.size + size > args.max_size:
+
+                logging.debug(f"{path} is {size} bytes which is too big to fit")
+                # If data has been written or copies left out, break so we close the current archive
+                if not archive.is_empty():
+                    break
+
+                # If this is a file, it is bigger than our archive file size, so this archive is its next volume
+                if traversal.is_file(path):
+                    part = 1
+                    if path == args.checkpoint and args.checkpoint_part is not None:
+                        part = args.checkpoint_part + 1
+                    logging.debug(f"{path} is larger than the maximum archive size so writing volume {part}")
+                    archive.add_volume(listing, part)
+                    break
+
+                # Try to recursively archive this listing, but continue here on failure
+                if archive_directory(args, path):
+                    return True
                 continue
 
-        # This size calculation could be slow, so pass the threshold value
-        size = get_size_with_timeout(path, args.max_size - archive.size)
-        logging.debug(f"size of {path} is >= {size}")
+            # Add this listing to our archive
+            archive.add(listing, size)
 
-        # If this item won't fit into the current archive
-        if archive.size + size > args.max_size:
+        # An empty archive means nothing was backed up, so return failure
+        if archive.is_empty():
+            return False
 
-            logging.debug(f"{path} is {size} bytes which is too big to fit")
-            # If data has been written, break so we close the current archive
-            if archive.size > 0:
-                break
+        # Directory successfully backed up, so close the archive and move forward our restart checkpoint
+        archive.rename(directory_list)
+        args.catalog.record(archive.name, archive.members)
+        args.catalog.record_references(archive.get_catalog_references())
+        args.checkpoint = os.path.join(dir_path, archive.last_item)
+        args.checkpoint_part = archive.next_part
+        if archive.size == 0:
+            logging.debug(f"{archive}: nothing written as every file was a copy, {len(archive.references)} recorded")
+            return True
+        fill = archive.size / args.max_size
+        rate = archive.size / max(archive.seconds, 1e-6) / 2**20
+        line = f"created {archive.name} {archive.size} {fill:.0%} {rate:.1f}MB/s"
+        record = timer.get_record(archive.name, archive.size, archive.size)
+        record['syscalls'] = traversal.syscalls - syscalls
+        logging.debug(f"{archive}: {record['syscalls']} metadata calls on the source for {len(archive.members)} "
+                      f"entries")
+        if args.stream:
+            report(args.working_dir, line, record=record)
+            archive.report_stages()
+        else:
+            report(args.working_dir, line, {'tar': archive.size}, record)
+            if args.handoff is not None:
+                args.handoff(archive.path)
+        logging.debug(f"Archiving completed to {args.checkpoint}")
+        return True
 
-            # If this is a file, it is bigger than our archive file size
-            if os.path.isfile(path):
-                logging.error(f"Unable to archive {path} as it is larger ({size}) than "
-                              f"the maximum archive size ({args.max_size})")
-                exit(1)
 
-            # Try to recursively archive this listing, but continue here on failure
-            if archive_directory(args, path):
-                return True
+# Return the name of the item in dir_path on the way to the checkpoint, or None if it is not below dir_path
+def get_checkpoint_name(checkpoint, dir_path):
+    prefix = os.path.join(dir_path, '')
+    if not checkpoint or not checkpoint.startswith(prefix):
+        return None
+    return checkpoint[len(prefix):].split('/', 1)[0]
+
+
+# Start measuring the directories among listings whose sizes will be needed and are not in the size index
+def look_ahead(args, lookahead, dir_path, listings):
+    for listing in listings:
+        if lookahead.is_full():
+            return
+        path = os.path.join(dir_path, listing)
+        if path in lookahead.seen:
             continue
+        lookahead.seen.add(path)
+        if path == args.working_dir or is_excluded(args, path) or not traversal.is_dir(path):
+            continue
+        path_stat = traversal.lstat(path)
+        if size_index.get(path, args.max_size, path_stat) is None:
+            lookahead.submit(path, path_stat)
 
-        # Add this listing to our archive
-        archive.add(listing, size)
 
-    # A zero size archive means nothing was backed up, so return failure
-    if archive.size == 0:
-        return False
+# True if path is a partition archived by another worker, or holds one
+def is_excluded(args, path):
+    return path in args.exclude or any(x.startswith(os.path.join(path, '')) for x in args.exclude)
+
+
+# Return the size of an item, or in an incremental pass the size of what has changed in it
+# Directories holding partitions archived by other workers are too big for any archive, so they are always gone into
+def get_item_size(args, path, max_size, changed_sizes, lookahead=None):
+    if path in args.exclude:
+        return 0
+    if any(x.startswith(os.path.join(path, '')) for x in args.exclude):
+        return args.max_size + 1
+    if not args.manifest.incremental:
+        return get_size_with_timeout(path, max_size, args.scan_threads, lookahead)
+    if path not in changed_sizes:
+        changed_sizes[path] = get_changed_size(path, args.manifest)
+    return changed_sizes[path]
+
+
+# Return the index in directory_list at which the archive starting at index start should close
+# Archives are filled as far as they go, unless that would leave a run of items ending before something too big
+# for any archive with a last archive under the minimum fill. Then the run is split evenly instead.
+def plan_archive(args, dir_path, directory_list, start, changed_sizes, lookahead=None):
+    sizes = []
+    total = 0
+    for index in range(start, len(directory_list)):
+        path = os.path.join(dir_path, directory_list[index])
+        if path == args.working_dir:
+            break
+        size = get_item_size(args, path, args.max_size, changed_sizes, lookahead)
+        if size > args.max_size:
+            break
+        sizes.append(size)
+        total += size
 
-    # Directory successfully backed up, so close the archive and move forward our restart checkpoint
-    archive.rename(directory_list)
-    args.checkpoint = os.path.join(dir_path, archive.last_item)
-    report(args.working_dir, f"created {archive.name} {archive.size}")
-    logging.debug(f"Archiving completed to {args.checkpoint}")
-    return True
+        # A run this long will fill its archives whichever way it is split
+        if total > PLAN_ARCHIVES * args.max_size:
+            return len(directory_list)
+
+    if not sizes:
+        return len(directory_list)
+    parts = split_sizes(sizes, args.max_size)
+    if sum(parts[-1]) >= args.min_fill * args.max_size:
+        return len(directory_list)
+
+    # Find the smallest archive size that still needs no more archives, and split the run with it
+    low, high = max(sizes), args.max_size
+    while low < high:
+        middle = (low + high) // 2
+        if len(split_sizes(sizes, middle)) > len(parts):
+            low = middle + 1
+        else:
+            high = middle
+    parts = split_sizes(sizes, low)
+    logging.debug(f"planned {len(parts)} archives in {dir_path} with fills "
+                  f"{', '.join(f'{sum(x) / args.max_size:.0%}' for x in parts)}")
+    return start + len(parts[0])
+
+
+# Split sizes in order into as few groups as possible that each total no more than max_size
+def split_sizes(sizes, max_size):
+    parts = [[]]
+    total = 0
+    for size in sizes:
+        if parts[-1] and total + size > max_size:
+            parts.append([])
+            total = 0
+        parts[-1].append(size)
+        total += size
+    return parts
 
 
 # Same as get_size but can short-circuit on large directories
-def get_size_with_timeout(path, max_size):
+# Sizes are what the item takes in a tar. Anything other than a directory is sized from its stat, taken from the
+# listing of its directory.
+def get_size_with_timeout(path, max_size, threads=16, lookahead=None):
+
+    # This stat is from before measuring, so changes made during the measurement invalidate it
+    path_stat = traversal.lstat(path)
+    if not stat.S_ISDIR(path_stat.st_mode):
+        return get_tar_size(path, path_stat.st_size if stat.S_ISREG(path_stat.st_mode) else 0)
+
+    size = size_index.get(path, max_size, path_stat)
+    if size is not None:
+        logging.debug(f"size index for {path} returning {size}")
+        return size
+
+    # A directory measured ahead was measured up to the largest limit, so its size answers any smaller one
+    if lookahead is not None:
+        size = lookahead.take(path)
+        if size is not None:
+            return size
+
+    # Stop measuring as soon as the size is known to be over the limit, remembering it as a lower bound
+    logging.debug(f"calculating the size of {path} up to {max_size}")
+    scanner = DirectoryScanner(max_size, threads)
+    size, complete = scanner.run(path)
+    record_size(path, path_stat, size, complete, scanner.syscalls)
+    return size
+
+
+# Keep a measured size in the size index, counting the calls made on the source to measure it
+def record_size(path, path_stat, size, complete, syscalls):
+    traversal.count(syscalls)
+    size_index.put(path, path_stat, size, complete)
+
+
+# Return the tar size of the files under path that have changed since they were last archived, along with the
+# headers of the directories written with them, or 0 if nothing has changed
+# Entries below path are stated once each through os.scandir, which gives their types without a call
+def get_changed_size(path, manifest):
+    size = 0
+    directories_size = 0
+    unchanged = []
+    pending = [(path, traversal.lstat(path))]
+    while pending:
+        entry_path, entry_stat = pending.pop()
+        if stat.S_ISDIR(entry_stat.st_mode):
+            directories_size += get_tar_size(entry_path, is_dir=True)
+            with os.scandir(entry_path) as entries:
+                for entry in entries:
+                    pending.append((entry.path, entry.stat(follow_symlinks=False)))
+                    traversal.count()
+            traversal.count()
+        elif manifest.is_changed(entry_path, entry_stat):
+            size += get_tar_size(entry_path, entry_stat.st_size if stat.S_ISREG(entry_stat.st_mode) else 0)
+        else:
+            unchanged.append(entry_path)
+    manifest.mark_seen(unchanged)
+    return size + directories_size if size else 0
 
-    global size_cache
-    if path in size_cache:
-        logging.debug(f"cache for {path} returning {size_cache[path]}")
-        return size_cache[path]
 
-    if os.path.isfile(path) or sys.platform != 'linux':
-        return get_size(path)
+# Files an incremental pass did not find have been deleted, so list them for the next stages
+# A pass is also a good time to send the catalog, as it then covers the whole source
+# Partitions leave the catalog to the process running them, which sends it once every partition is through
+def finish_pass(args):
+    number = args.manifest.number
+    deleted = args.manifest.finish_pass()
+    if deleted:
+        write_deletions(args, deleted, number)
+    args.pass_finished = True
+    if args.workers == 1:
+        ship_catalog(args, args.catalog)
 
-    # Estimate the maximum number of seconds to wait
-    sec = max_size / DU_MIN_BYTES_PER_SEC
-    logging.debug(f"calculating the size of {path} with timeout set in {sec} seconds")
 
-    # Try to get the size of path, but only wait as long as an answer is expected to take
+# Write the list of deleted files to go through the pipeline with the archives, named for the pass that found them
+def write_deletions(args, deleted, number):
+    timer = StageTimer('archive')
+    name = f"{get_dotted_name(args.source)}_DELETED.{datetime.today().strftime('%Y%m%d')}.inc{number}.txt"
+    tmp_path = os.path.join(args.working_dir, args.temp, name)
+    with open(tmp_path, 'w') as f:
+        for path in deleted:
+            f.write(f"{path}\n")
+    ship_file(args, tmp_path, name, timer)
+
+
+# Send a copy of the catalog through the pipeline with the archives, so it can be restored to find files in them
+# A copy can be sent more than once a day, so each is numbered as well
+def ship_catalog(args, catalog):
+    timer = StageTimer('archive')
+    date = datetime.today().strftime('%Y%m%d')
+    name = f"{get_dotted_name(args.source)}_CATALOG.{date}.copy{catalog.count_shipped()}.sqlite"
+    tmp_path = os.path.join(args.working_dir, args.temp, name)
+    if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+    catalog.ship(tmp_path)
+    ship_file(args, tmp_path, name, timer)
+
+
+# Move a finished file from the temporary folder into the destination folder for the next stages,
+# or with --stream compress, encrypt and upload it straight away
+def ship_file(args, tmp_path, name, timer):
+    size = os.path.getsize(tmp_path)
+    record = timer.get_record(name, size, size)
+    if args.stream:
+        try:
+            uploaded = stream_file(args, tmp_path, f"{name}.xz.gpg")
+        finally:
+            os.remove(tmp_path)
+        report(args.working_dir, f"created {name} {size}", record=record)
+        report(args.working_dir, f"uploaded {name}.xz.gpg {uploaded}")
+        return
+
+    path = os.path.join(args.working_dir, args.destination, name)
+    if os.path.exists(path):
+        raise FileExistsError(f"{path} already exists")
+    os.rename(tmp_path, path)
+    report(args.working_dir, f"created {name} {size}", {'tar': size}, record)
+    if args.handoff is not None:
+        args.handoff(path)
+
+
+# Compress, encrypt and upload a single file as upload_name, returning the bytes uploaded
+def stream_file(args, path, upload_name):
+    xz = subprocess.Popen(get_compress_command(args.threads, path), stdout=subprocess.PIPE)
+    gpg = subprocess.Popen(get_encrypt_command(args.working_dir, '-'), stdin=xz.stdout, stdout=subprocess.PIPE)
+    xz.stdout.close()
+
+    # Only let the upload complete if both processes finished cleanly
+    def verify():
+        for child in (xz, gpg):
+            if child.wait() != 0:
+                raise Exception(f"command '{' '.join(child.args)}' failed with return code {child.returncode}")
+
     try:
-        size = int(subprocess.check_output(['du', '-sb', path], timeout=sec).split()[0])
-        size_cache[path] = size
-        return size
-    except subprocess.TimeoutExpired:
-        # Pass through, and we will attempt to get the size in pieces
-        logging.debug(f"size calculation timed out. calculating directory size piecemeal.")
-        pass
+        return upload_stream(gpg.stdout, upload_name, args.bucket, verify=verify)
+    except BaseException:
+        xz.kill()
+        gpg.kill()
+        raise
+    finally:
+        xz.wait()
+        gpg.wait()
 
-    # Step through each item in the directory
-    total_size = 0
-    for listing in os.listdir(path):
-        subpath = os.path.join(path, listing)
-        total_size += get_size_with_timeout(subpath, max_size)
 
-        # Short-circuit this process if we already are beyond the maximum
-        if total_size > max_size:
-            break
-    else:
-        logging.debug(f"timeout reached on {path} for {max_size} but size was only {total_size}")
+# Bytes of a file put in each volume, leaving room in the archive for the tar header and padding
+def get_volume_size(max_size):
+    return (max_size - 4 * tarfile.RECORDSIZE) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+
+
+# Write part of a file into tar as a member of its own, named for the file with the part number
+# Restoring the file is a matter of joining its parts in order
+def write_volume(tar, path, part, offset, length):
+    tarinfo = tar.gettarinfo(path, f"{path}.part{part:04d}")
+    tarinfo.size = length
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        tar.addfile(tarinfo, f)
+
+
+# TarFile that hashes the data of each regular file as it is written, keeping the hashes by source path
+# and every member as (path, size, mtime, offset) for the catalog
+# With a prefetcher, files are read with sequential read-ahead and the prefetcher is told as each one is read
+# Directories are listed and headers are built through the traversal, and only regular files are stated again
+class HashingTarFile(tarfile.TarFile):
+
+    def __init__(self, *args, hashes=None, members=None, prefetcher=None, notes=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hashes = {} if hashes is None else hashes
+        self.catalog_members = [] if members is None else members
+        self.prefetcher = prefetcher
+        self.notes = notes
+        self.owners = {}
+
+    # Add one entry at a time, so an entry that cannot be read is skipped on its own and the rest are still added
+    # Returns False if name itself was skipped
+    def add(self, name, arcname=None, recursive=True, *, filter=None):
+        if arcname is None:
+            arcname = name
+        savepoint = self.get_savepoint()
+        try:
+            super().add(name, arcname, recursive=False, filter=filter)
+        except PermissionError:
+            logging.error(f"Permission denied attempting to archive {name}")
+            self.rollback(savepoint)
+            return False
+        if recursive and traversal.is_dir(name):
+            try:
+                listings = traversal.list(name)
+            except PermissionError:
+                logging.error(f"Permission denied attempting to list {name}")
+                return True
+            for listing in listings:
+                self.add(os.path.join(name, listing), os.path.join(arcname, listing), filter=filter)
+        return True
+
+    # Everything an entry can add to, so a failed entry can be dropped: the tar offset and hash, the members and
+    # hard link targets, and the lists the filter notes files in
+    # A stream cannot be rolled back, but nothing reaches it before the file of an entry has been opened
+    def get_savepoint(self):
+        file_hash = None
+        if isinstance(self.fileobj, HashingWriter) and self.fileobj.seekable():
+            file_hash = self.fileobj.hash.copy()
+        return (self.offset, file_hash, len(self.members), len(self.inodes), len(self.catalog_members),
+                [len(x) for x in self.notes])
+
+    # Drop a partially written entry. Hard link targets are only ever added to the map, so the ones first seen in
+    # the entry are the last ones in it.
+    def rollback(self, savepoint):
+        offset, file_hash, member_count, inode_count, catalog_count, note_counts = savepoint
+        if self.offset != offset:
+            if file_hash is None:
+                raise ValueError(f"a tar stream cannot be rolled back to offset {offset}")
+            self.fileobj.rollback(offset, file_hash)
+            self.offset = offset
+        del self.members[member_count:]
+        for inode in list(self.inodes)[inode_count:]:
+            del self.inodes[inode]
+        del self.catalog_members[catalog_count:]
+        for notes, count in zip(self.notes, note_counts):
+            del notes[count:]
+
+    # Build the header as TarFile.gettarinfo does, from the traversal's stat and with owner names looked up once
+    # That stat can be from long before, when the item was sized and planned, so a regular file is stated again.
+    # Its header then holds the size of the data read, even if the file has grown or shrunk since.
+    def gettarinfo(self, name=None, arcname=None, fileobj=None):
+        if fileobj is not None or self.dereference:
+            return super().gettarinfo(name, arcname, fileobj)
+        if arcname is None:
+            arcname = name
+        arcname = arcname.replace(os.sep, "/").lstrip("/")
+        path_stat = traversal.lstat(name)
+        if stat.S_ISREG(path_stat.st_mode):
+            traversal.count()
+            path_stat = os.lstat(name)
+        mode = path_stat.st_mode
 
-    return total_size
+        tarinfo = self.tarinfo()
+        tarinfo.tarfile = self
+        linkname = ""
+        if stat.S_ISREG(mode):
+            inode = (path_stat.st_ino, path_stat.st_dev)
+            if path_stat.st_nlink > 1 and inode in self.inodes and arcname != self.inodes[inode]:
+                kind = tarfile.LNKTYPE
+                linkname = self.inodes[inode]
+            else:
+                kind = tarfile.REGTYPE
+                if inode[0]:
+                    self.inodes[inode] = arcname
+        elif stat.S_ISDIR(mode):
+            kind = tarfile.DIRTYPE
+        elif stat.S_ISFIFO(mode):
+            kind = tarfile.FIFOTYPE
+        elif stat.S_ISLNK(mode):
+            kind = tarfile.SYMTYPE
+            linkname = os.readlink(name)
+            traversal.count()
+        elif stat.S_ISCHR(mode):
+            kind = tarfile.CHRTYPE
+        elif stat.S_ISBLK(mode):
+            kind = tarfile.BLKTYPE
+        else:
+            return None
+
+        tarinfo.name = arcname
+        tarinfo.mode = mode
+        tarinfo.uid = path_stat.st_uid
+        tarinfo.gid = path_stat.st_gid
+        tarinfo.size = path_stat.st_size if kind == tarfile.REGTYPE else 0
+        tarinfo.mtime = path_stat.st_mtime
+        tarinfo.type = kind
+        tarinfo.linkname = linkname
+        tarinfo.uname, tarinfo.gname = self.get_owner_names(path_stat.st_uid, path_stat.st_gid)
+        if kind in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+            tarinfo.devmajor = os.major(path_stat.st_rdev)
+            tarinfo.devminor = os.minor(path_stat.st_rdev)
+        return tarinfo
+
+    def get_owner_names(self, uid, gid):
+        if (uid, gid) not in self.owners:
+            try:
+                uname = pwd.getpwuid(uid)[0]
+            except KeyError:
+                uname = ""
+            try:
+                gname = grp.getgrgid(gid)[0]
+            except KeyError:
+                gname = ""
+            self.owners[uid, gid] = (uname, gname)
+        return self.owners[uid, gid]
+
+    def addfile(self, tarinfo, fileobj=None):
+        self.catalog_members.append(("/" + tarinfo.name, tarinfo.size, int(tarinfo.mtime), self.offset))
+        if fileobj is None:
+            return super().addfile(tarinfo)
+        if self.prefetcher is not None:
+            os.posix_fadvise(fileobj.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        reader = HashingReader(fileobj)
+        super().addfile(tarinfo, reader)
+        self.hashes["/" + tarinfo.name] = reader.hash.hexdigest()
+        if self.prefetcher is not None:
+            self.prefetcher.consume("/" + tarinfo.name)
 
 
 class Archive:
 
-    def __init__(self, dest_dir, source_path, max_size):
+    def __init__(self, dest_dir, source_path, max_size, manifest=None, dedup=False):
         self.dest_dir = dest_dir
         self.source_path = source_path
         self.max_size = max_size
+        self.manifest = manifest
+        self.dedup = dedup
+        self.files = []
+        self.references = []
+        self.hashes = {}
+        self.members = []
 
         self.name = f"{get_temp_file_name()}.tar"
         self.path = os.path.join(self.dest_dir, "tmp", self.name)
         self.tmp_flag = True
+        self.tar = None
+        self.file = None
         self.size = 0
         self.date = None
         self.first_item = None
         self.last_item = None
+        self.part = None
+        self.next_part = None
+        self.prefetcher = None
+        self.seconds = 0
         assert not os.path.isfile(self.path)
         logging.debug(f"{self}: created for directory {self.source_path}")
 
+    def __enter__(self):
+        return self
+
+    # Any archive not renamed by the end of the block is partial output, so remove it
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.discard()
+
     def __del__(self):
+        self.discard()
+
+    # Close and delete a partially written archive
+    def discard(self):
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
         if self.tmp_flag and os.path.isfile(self.path):
             os.remove(self.path)
             logging.debug(f"{self}: deleted")
@@ -227,14 +905,23 @@ class Archive:
         if self.size + size > self.max_size:
             raise OverflowError
 
+        # Open the tar file once and keep writing to it until the archive is renamed
+        if self.tar is None:
+            self.open()
+
         logging.debug(f"{self}: adding item {item} of size {size}")
-        with tarfile.open(self.path, 'a', format=tarfile.GNU_FORMAT) as f:
-            try:
-                f.add(os.path.join(self.source_path, item))
-            # Skip files for which the permission is denied
-            except PermissionError:
-                logging.error(f"Permission denied attempting to archive item {item} in directory {self.source_path}")
-                return
+        path = os.path.join(self.source_path, item)
+        start = time.monotonic()
+        try:
+            # The item is walked a second time to read it ahead, so its listings are kept for tar
+            with traversal.pin(path if self.prefetcher is not None else None):
+                if self.prefetcher is not None:
+                    self.prefetcher.extend(get_tar_order(path, traversal))
+                # Entries for which the permission is denied are skipped
+                if not self.tar.add(path, filter=self.filter):
+                    return
+        finally:
+            self.seconds += time.monotonic() - start
 
         # For the first item put in, timestamp the archive
         if self.first_item is None:
@@ -242,33 +929,328 @@ class Archive:
             self.date = datetime.today().strftime('%Y%m%d')
         self.last_item = item
 
-        # Update our size with the actual value
-        self.size = get_size(self.path)
+        # The tar offset counts every header and data block written so far
+        self.size = self.tar.offset
+
+    # Fill the archive with the next volume of a file too large for one archive
+    # The file is stated again as its header is written, so the volumes follow its size as it is now
+    def add_volume(self, item, part):
+        path = os.path.join(self.source_path, item)
+        traversal.count()
+        stat = os.lstat(path)
+        volume_size = get_volume_size(self.max_size)
+        offset = (part - 1) * volume_size
+        length = min(volume_size, stat.st_size - offset)
+
+        if self.tar is None:
+            self.open()
+        logging.debug(f"{self}: adding volume {part} of item {item} from {offset} for {length} bytes")
+        start = time.monotonic()
+        write_volume(self.tar, path, part, offset, length)
+        self.seconds += time.monotonic() - start
+        self.set_volume(item, part, stat, offset + length)
+        self.size = self.tar.offset
+
+    # The tar is hashed as it is written, so the compressor can check it reads back the same bytes
+    def open(self):
+        self.file = HashingWriter(open(self.path, 'wb'))
+        self.tar = HashingTarFile.open(fileobj=self.file, mode='w', format=tarfile.GNU_FORMAT, hashes=self.hashes,
+                                       members=self.members, prefetcher=self.prefetcher,
+                                       notes=(self.files, self.references))
+
+    # Name the archive for the volume, and once the last volume is written note the file as archived
+    def set_volume(self, item, part, stat, end):
+        self.first_item = item
+        self.last_item = item
+        self.date = datetime.today().strftime('%Y%m%d')
+        self.part = part
+        self.next_part = part if end < stat.st_size else None
+        if self.next_part is None:
+            self.files.append((os.path.join(self.source_path, item), stat, None))
+
+    # Note each file as it is written, leaving out unchanged files in an incremental pass
+    # and files whose content is already archived when deduplicating
+    def filter(self, tarinfo):
+        if self.manifest is None or tarinfo.isdir():
+            return tarinfo
+        path = "/" + tarinfo.name
+        stat = traversal.lstat(path)
+        if self.manifest.incremental and not self.manifest.is_changed(path, stat):
+            return None
+
+        prehash = None
+        if self.dedup and tarinfo.isreg() and stat.st_size >= DEDUP_MIN_SIZE:
+            prehash = get_prehash(path, stat.st_size)
+            copy = self.find_copy(path, stat.st_size, prehash)
+            if copy is not None:
+                logging.debug(f"{self}: {path} is a copy of {copy[1]}")
+                self.references.append((path, stat, prehash) + copy)
+                return None
+        self.files.append((path, stat, prehash))
+        return tarinfo
+
+    # Return (sha256, path, archive) of an archived copy of path, where an archive of None is this one
+    def find_copy(self, path, size, prehash):
+        copies = self.manifest.get_copies(size, prehash)
+        copies += [(self.hashes[x], x, None) for x, stat, x_prehash in self.files
+                   if stat.st_size == size and x_prehash == prehash and x in self.hashes]
+        if not copies:
+            return None
+
+        # Only a matching hash of the whole file proves it is a copy
+        sha256 = get_file_hash(path)
+        for copy in copies:
+            if copy[0] == sha256:
+                return copy
+        return None
+
+    # True if nothing has been written and no file has been left out as a copy, so there is nothing to record
+    def is_empty(self):
+        return self.size == 0 and not self.references
+
+    # Files left out as copies, as the catalog records them with the archive holding each copy
+    def get_catalog_references(self):
+        return [(path, stat.st_size, int(stat.st_mtime), copy_path, copy_archive or self.name)
+                for path, stat, _, _, copy_path, copy_archive in self.references]
+
+    # Calculate the final name of the archive from its contents
+    # Incremental passes archive the same ranges again, so their archives are named for the pass as well
+    def get_name(self, dir_listing):
+        # Filename begins with the path with slashes to dots
+        name = get_dotted_name(self.source_path)
+        range_descriptor = get_filename_range_descriptor(self.first_item, self.last_item, dir_listing)
+        date = self.date
+        if self.manifest is not None and self.manifest.incremental:
+            date = f"{date}.inc{self.manifest.number}"
+        if self.part is not None:
+            return f"{name}.{range_descriptor}.part{self.part:04d}.{date}.tar"
+        return f"{name}.{range_descriptor}.{date}.tar"
 
     def rename(self, dir_listing):
         # Don't bother to rename if the archive is empty
         if self.first_item is None:
             return
 
-        # Filename begins with the path with slashes to dots
-        name = self.source_path.replace('/', '.').replace('\\', '.')
-        while name[0] == ".":
-            name = name[1:]
+        # Nothing is written when every file was a copy of one already archived, which only needs recording
+        if self.size == 0:
+            if self.manifest is not None:
+                self.manifest.record_references(self.references, self.name)
+            return
 
-        range_descriptor = get_filename_range_descriptor(self.first_item, self.last_item, dir_listing)
-        name = f"{name}.{range_descriptor}.{self.date}.tar"
+        # Never replace an archive already written
+        name = self.get_name(dir_listing)
         archive_path = os.path.join(self.dest_dir, "tar", name)
-        assert not os.path.isfile(archive_path)
+        if os.path.exists(archive_path):
+            raise FileExistsError(f"{self}: {archive_path} already exists")
+
+        # Write the end of archive blocks before the file is handed to the next stage
+        self.tar.close()
+        self.tar = None
+        self.file.close()
+        self.size = self.file.size
+        record_checksum(self.dest_dir, name, self.file.hash.hexdigest(), self.size)
+        self.file = None
 
         os.rename(self.path, archive_path)
         logging.debug(f"{self}: renamed to {name}")
         self.name = name
         self.path = archive_path
         self.tmp_flag = False
+        if self.manifest is not None:
+            self.manifest.record(self.files, self.name, self.hashes)
+            self.manifest.record_references(self.references, self.name)
 
     def __str__(self):
         return f"Archive {self.name}"
 
 
+# Writer that calls start just before the first bytes are written through it
+class StartingWriter:
+
+    def __init__(self, fileobj, start):
+        self.fileobj = fileobj
+        self.start = start
+        self.started = False
+
+    def write(self, data):
+        if data and not self.started:
+            self.started = True
+            self.start()
+        return self.fileobj.write(data)
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        self.fileobj.close()
+
+
+# An archive that is written straight through compression, encryption and upload when it is renamed
+class StreamArchive(Archive):
+
+    def __init__(self, dest_dir, source_path, max_size, threads=1, destination=BUCKET, manifest=None, dedup=False):
+        super().__init__(dest_dir, source_path, max_size, manifest, dedup)
+        self.threads = threads
+        self.destination = destination
+        self.items = []
+        self.volume = None
+        self.compressed_size = None
+        self.encrypted_size = None
+        self.timers = None
+        self.upload_cpu = 0
+
+    # Items are only collected here as nothing can be streamed until the archive name is known
+    def add(self, item, size):
+        if self.size + size > self.max_size:
+            raise OverflowError
+
+        logging.debug(f"{self}: adding item {item} of size {size}")
+        self.items.append(item)
+        if self.first_item is None:
+            self.first_item = item
+            self.date = datetime.today().strftime('%Y%m%d')
+        self.last_item = item
+
+        # Until the tar is written its size is estimated from the item sizes
+        self.size += size
+
+    # Note the next volume of a file too large for one archive, which is written on its own
+    def add_volume(self, item, part):
+        stat = traversal.lstat(os.path.join(self.source_path, item))
+        volume_size = get_volume_size(self.max_size)
+        offset = (part - 1) * volume_size
+        self.volume = (offset, min(volume_size, stat.st_size - offset))
+        self.set_volume(item, part, stat, offset + self.volume[1])
+        self.size = self.volume[1]
+
+    def rename(self, dir_listing):
+        if self.first_item is None:
+            return
+
+        # Never replace an archive already uploaded, checking before anything is written
+        name = self.get_name(dir_listing)
+        upload_name = f"{name}.xz.gpg"
+        check_not_uploaded(upload_name, self.destination)
+        self.timers = {'compress': StageTimer('compress'), 'encrypt': StageTimer('encrypt')}
+        # Fixed size blocks let a restore decompress only the blocks holding the files it wants
+        xz = subprocess.Popen(get_compress_command(self.threads, block_size=DEFAULT_BLOCK_SIZE), stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE)
+        gpg = subprocess.Popen(get_encrypt_command(self.dest_dir, '-'), stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE)
+
+        # The bytes on every pipe are hashed as they pass, and logged as the checksums of the archive
+        compressed_stream = HashingReader(xz.stdout)
+        encrypted_stream = HashingReader(gpg.stdout)
+
+        # Only let the upload complete if every process upstream of it finished cleanly
+        # The processes are waited for by this thread, which counts the CPU they used
+        exited = threading.Event()
+
+        def verify():
+            exited.wait()
+            for child in (xz, gpg):
+                if child.returncode != 0:
+                    raise Exception(f"command '{' '.join(child.args)}' failed with return code {child.returncode}")
+
+        def upload(*args):
+            start = time.thread_time()
+            size = upload_stream(*args)
+            self.upload_cpu = time.thread_time() - start
+            return size
+
+        # Any failure kills the processes so the other threads see their pipes close
+        def run(function, *args):
+            try:
+                return function(*args)
+            except BaseException:
+                xz.kill()
+                gpg.kill()
+                raise
+
+        # The upload starts with the first bytes of the tar, so nothing is sent if every file was left out as a copy
+        uploads = []
+
+        def start_upload():
+            uploads.append(pool.submit(run, upload, encrypted_stream, upload_name, self.destination, self.size, verify))
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            compressed = pool.submit(run, self.pipe, compressed_stream, gpg.stdin)
+            tar_stream = HashingWriter(StartingWriter(xz.stdin, start_upload))
+            try:
+                run(self.write, tar_stream)
+            finally:
+                try:
+                    self.timers['compress'].wait(xz)
+                    self.timers['encrypt'].wait(gpg)
+                finally:
+                    exited.set()
+            self.compressed_size = compressed.result()
+            if not uploads:
+                gpg.stdout.close()
+                logging.debug(f"{self}: nothing written as every file was a copy")
+                self.size = 0
+                if self.manifest is not None:
+                    self.manifest.record_references(self.references, self.name)
+                return
+            self.encrypted_size = uploads[0].result()
+
+        logging.debug(f"{self}: streamed to {upload_name}")
+        for stream_name, stream in ((name, tar_stream), (f"{name}.xz", compressed_stream),
+                                    (upload_name, encrypted_stream)):
+            logging.debug(f"{self}: {stream_name} has sha256 {stream.hash.hexdigest()} and size {stream.size}")
+        self.name = name
+        self.path = None
+        self.tmp_flag = False
+        if self.manifest is not None:
+            self.manifest.record(self.files, self.name, self.hashes)
+            self.manifest.record_references(self.references, self.name)
+
+    # Write every item as a tar stream into xz
+    def write(self, stream):
+        start = time.monotonic()
+        with traversal.pin(self.source_path if self.prefetcher is not None else None):
+            if self.prefetcher is not None:
+                for item in self.items:
+                    self.prefetcher.extend(get_tar_order(os.path.join(self.source_path, item), traversal))
+            tar = HashingTarFile.open(fileobj=stream, mode='w', format=tarfile.GNU_FORMAT, hashes=self.hashes,
+                                      members=self.members, prefetcher=self.prefetcher,
+                                      notes=(self.files, self.references))
+            if self.volume is not None:
+                write_volume(tar, os.path.join(self.source_path, self.first_item), self.part, *self.volume)
+            for item in self.items:
+                tar.add(os.path.join(self.source_path, item), filter=self.filter)
+
+            # A tar with nothing in it is not even given its end of archive blocks, so nothing is sent
+            if tar.offset > 0:
+                tar.close()
+        stream.close()
+        self.seconds = time.monotonic() - start
+
+        # The tar is padded out to a whole record once it is closed
+        self.size = -(-tar.offset // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+    # Copy the compressed stream into gpg and return the number of compressed bytes
+    @staticmethod
+    def pipe(src, dst):
+        size = copy_stream(src, dst)
+        dst.close()
+        return size
+
+    # Write the log entries each stage would have written for a staged archive
+    # Every stage ran over the same span of time, so each is timed with the CPU of its own process or thread
+    def report_stages(self):
+        start = self.timers['compress'].start
+        end = time.time()
+        report(self.dest_dir, f"compressed {self.name}.xz {self.compressed_size}",
+               record=get_record('compress', f"{self.name}.xz", start, end, self.size, self.compressed_size,
+                                 self.timers['compress'].child_cpu))
+        report(self.dest_dir, f"encrypted {self.name}.xz.gpg {self.encrypted_size}",
+               record=get_record('encrypt', f"{self.name}.xz.gpg", start, end, self.compressed_size,
+                                 self.encrypted_size, self.timers['encrypt'].child_cpu))
+        report(self.dest_dir, f"uploaded {self.name}.xz.gpg {self.encrypted_size}",
+               record=get_record('upload', f"{self.name}.xz.gpg", start, end, self.encrypted_size,
+                                 self.encrypted_size, self.upload_cpu))
+
+
 if __name__ == '__main__':
     main()
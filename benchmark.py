@@ -0,0 +1,354 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import archiver
+from catalog import Catalog
+from common import convert_tgmk
+from compressor import CODEC_SUFFIXES, compress
+from encrypter import encrypt
+from manifest import Manifest
+from multipart import DirectoryBackend, MIN_PART_SIZE, SimulatedBackend
+from scheduler import get_hour_start, parse_windows, SimulatedClock, UploadScheduler
+from size_index import SizeIndex
+from traversal import Traversal
+from uploader import upload, upload_all, upload_stream
+
+# Text repeated through the compressible part of synthetic files
+FILLER = b"the quick brown fox jumps over the lazy archiver\n"
+
+# Stand-in for the aws cli that finds no existing objects and swallows whatever it is asked to upload
+FAKE_AWS = "#!/bin/sh\n[ \"$1\" = s3api ] && exit 254\nexec cat > /dev/null\n"
+
+
+parser = argparse.ArgumentParser(description='Measure the throughput of pipeline stages on synthetic data.')
+parser.add_argument('stage', choices=['all', 'archive', 'size', 'compress', 'codec', 'encrypt', 'upload', 'schedule'],
+                    help='stage to benchmark')
+parser.add_argument('-n', '--count', default=8, type=int, help='number of synthetic archives')
+parser.add_argument('-s', '--size', default='64M', type=convert_tgmk,
+                    help='size of each synthetic archive (K, M, G, P supported)')
+parser.add_argument('-j', '--jobs', default=os.cpu_count(), type=int, help='parallel jobs to compare against serial')
+parser.add_argument('-t', '--threads', default=1, type=int, help='threads for each compression job')
+parser.add_argument('--files', default=1000, type=int, help='number of files in the synthetic tree')
+parser.add_argument('--file-size', default='256K', type=convert_tgmk,
+                    help='average size of a file in the synthetic tree (K, M, G, P supported)')
+parser.add_argument('--depth', default=3, type=int, help='directory depth of the synthetic tree')
+parser.add_argument('--fanout', default=4, type=int, help='subdirectories in each directory of the synthetic tree')
+parser.add_argument('--compressibility', default=0.5, type=float,
+                    help='fraction of each synthetic file that is repetitive text rather than random bytes')
+parser.add_argument('-m', '--max-size', default='16M', type=convert_tgmk,
+                    help='maximum archive size when benchmarking the archiver (K, M, G, P supported)')
+parser.add_argument('--seed', default=0, type=int, help='seed for the synthetic file sizes')
+parser.add_argument('--hours', default='20-21=40K,2-4=80K',
+                    help='upload windows and rates to simulate a schedule with, as the uploader takes them')
+parser.add_argument('--link-speed', default='1M', type=convert_tgmk,
+                    help='bytes per second the simulated link sends at (K, M, G, P supported)')
+parser.add_argument('--work', default=None, type=os.path.abspath,
+                    help='directory to build test data in, a temporary directory by default')
+
+
+def main():
+    args = parser.parse_args()
+    stages = BENCHMARKS if args.stage == 'all' else [args.stage]
+    for stage in stages:
+        for result in BENCHMARKS[stage](args):
+            print(json.dumps(result), flush=True)
+
+
+# Return size bytes with the given fraction of repetitive text, the rest random
+def make_data(size, compressibility):
+    repetitive = int(size * compressibility)
+    filler = FILLER * (repetitive // len(FILLER) + 1)
+    return filler[:repetitive] + os.urandom(size - repetitive)
+
+
+def write_file(path, size, compressibility):
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            chunk = min(remaining, 2**20)
+            f.write(make_data(chunk, compressibility))
+            remaining -= chunk
+
+
+# Write count files of size bytes into path
+def make_archives(path, count, size, suffix, compressibility=0):
+    os.makedirs(path, exist_ok=True)
+    paths = []
+    for i in range(count):
+        paths.append(os.path.join(path, f"synthetic{i:04d}.{suffix}"))
+        write_file(paths[-1], size, compressibility)
+    return paths
+
+
+# Build a tree of args.files files spread over args.fanout ** args.depth leaf directories
+# File sizes are drawn from an exponential distribution around args.file_size. Returns the total bytes written.
+def make_tree(args, path):
+    directories = ['']
+    for _ in range(args.depth):
+        directories = [os.path.join(x, f"dir{i:02d}") for x in directories for i in range(args.fanout)]
+    rng = random.Random(args.seed)
+    total = 0
+    for i in range(args.files):
+        directory = os.path.join(path, directories[i % len(directories)])
+        os.makedirs(directory, exist_ok=True)
+        size = int(rng.expovariate(1 / max(args.file_size, 1)))
+        write_file(os.path.join(directory, f"file{i:06d}"), size, args.compressibility)
+        total += size
+    return total
+
+
+# Create an empty working directory with a passphrase, removed again when the benchmark is done
+def make_working_dir(args):
+    working_dir = tempfile.mkdtemp(prefix='archiver-benchmark-', dir=args.work)
+    for name in ('tar', 'xz', 'gpg', 'tmp', 'uploads', 'bucket'):
+        os.makedirs(os.path.join(working_dir, name))
+    with open(os.path.join(working_dir, 'passphrase.txt'), 'w') as f:
+        f.write('benchmark passphrase for synthetic archives\n')
+    return working_dir
+
+
+# Run function on each item with jobs workers, returning the total seconds and the seconds each item took
+# A single job runs in this thread, as some stages keep state that only this thread may use
+def run_timed(function, items, jobs):
+    def timed(item):
+        start = time.monotonic()
+        function(item)
+        return time.monotonic() - start
+
+    start = time.monotonic()
+    if jobs == 1:
+        latencies = [timed(x) for x in items]
+    else:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            latencies = list(pool.map(timed, items))
+    return time.monotonic() - start, latencies
+
+
+def get_result(stage, jobs, count, size, seconds, latencies=None):
+    result = {'stage': stage, 'jobs': jobs, 'files': count, 'bytes': size, 'seconds': round(seconds, 3),
+              'mb_per_sec': round(size / max(seconds, 1e-6) / 2**20, 2)}
+    if latencies:
+        latencies = sorted(latencies)
+        result.update({'latency_mean': round(sum(latencies) / len(latencies), 4),
+                       'latency_p50': round(latencies[len(latencies) // 2], 4),
+                       'latency_p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 4),
+                       'latency_max': round(latencies[-1], 4)})
+    return result
+
+
+# Archive a synthetic tree into staged tar files, timing each archive and counting metadata calls on the tree, with
+# directory sizes measured ahead in the background and then only when reached
+# Then archive it again with a worker for each top level directory
+def bench_archive(args):
+    working_dir = make_working_dir(args)
+    try:
+        source = os.path.join(working_dir, 'source')
+        size = make_tree(args, source)
+        for lookahead in (archiver.parser.get_default('lookahead'), 0):
+            archive_dir = make_working_dir(args)
+            try:
+                result = archive_tree(args, source, archive_dir, size, lookahead)
+                yield result if lookahead else dict(result, stage='archive-no-lookahead')
+            finally:
+                shutil.rmtree(archive_dir)
+
+        partition_dir = make_working_dir(args)
+        try:
+            archive_args = archiver.parser.parse_args([source, partition_dir, '-m', str(args.max_size),
+                                                       '--partitions', 'top'])
+            start = time.monotonic()
+            archiver.run_partitions(archive_args)
+            seconds = time.monotonic() - start
+            yield get_result('archive-partitions', args.fanout + 1, args.files, size, seconds)
+        finally:
+            shutil.rmtree(partition_dir)
+    finally:
+        shutil.rmtree(working_dir)
+
+
+def archive_tree(args, source, working_dir, size, lookahead):
+    archive_args = archiver.parser.parse_args([source, working_dir, '-m', str(args.max_size), '--lookahead',
+                                               str(lookahead)])
+    archive_args.manifest = Manifest(os.path.join(working_dir, 'manifest.sqlite'))
+    archive_args.manifest.start_pass(incremental=False)
+    archive_args.catalog = Catalog(os.path.join(working_dir, 'catalog.sqlite'))
+    archiver.size_index = SizeIndex(":memory:")
+    archiver.traversal = Traversal()
+
+    latencies = []
+    start = time.monotonic()
+    while True:
+        archive_start = time.monotonic()
+        if not archiver.archive_directory(archive_args, source):
+            break
+        latencies.append(time.monotonic() - archive_start)
+    seconds = time.monotonic() - start
+    entries = len(archive_args.catalog.find(source))
+    archive_args.manifest.close()
+    archive_args.catalog.close()
+    result = get_result('archive', 1, args.files, size, seconds, latencies)
+    result['syscalls_per_entry'] = round(archiver.traversal.syscalls / max(entries, 1), 2)
+    return result
+
+
+# Measure the size of every directory of a synthetic tree with a cold size index, with one and args.jobs threads
+def bench_size(args):
+    working_dir = make_working_dir(args)
+    try:
+        source = os.path.join(working_dir, 'source')
+        size = make_tree(args, source)
+        directories = [source] + [os.path.join(source, x) for x in sorted(os.listdir(source))]
+        for jobs in sorted({1, args.jobs}):
+            archiver.size_index = SizeIndex(":memory:")
+            seconds, latencies = run_timed(lambda x: archiver.get_size_with_timeout(x, 2**62, jobs), directories, 1)
+            yield get_result('size', jobs, args.files, size, seconds, latencies)
+    finally:
+        archiver.size_index = SizeIndex(":memory:")
+        shutil.rmtree(working_dir)
+
+
+# Compress the same synthetic archives serially and then with args.jobs workers
+def bench_compress(args):
+    for jobs in sorted({1, args.jobs}):
+        working_dir = make_working_dir(args)
+        try:
+            paths = make_archives(os.path.join(working_dir, 'tar'), args.count, args.size, 'tar', args.compressibility)
+            stage_args = argparse.Namespace(working_dir=working_dir, source='tar', destination='xz', temp='tmp',
+                                            threads=args.threads, codec='xz')
+            seconds, latencies = run_timed(lambda x: compress(stage_args, x), paths, jobs)
+            yield get_result('compress', jobs, args.count, args.count * args.size, seconds, latencies)
+        finally:
+            shutil.rmtree(working_dir)
+
+
+# Compress synthetic archives of text, random and mixed data with each codec, comparing size against CPU time
+def bench_codec(args):
+    for compressibility in (1.0, 0.0, args.compressibility):
+        for codec in ['auto'] + list(CODEC_SUFFIXES):
+            if codec == 'zstd' and shutil.which('zstd') is None:
+                continue
+            working_dir = make_working_dir(args)
+            try:
+                paths = make_archives(os.path.join(working_dir, 'tar'), args.count, args.size, 'tar', compressibility)
+                stage_args = argparse.Namespace(working_dir=working_dir, source='tar', destination='xz', temp='tmp',
+                                                threads=args.threads, codec=codec)
+                cpu_start = sum(os.times()[:4])
+                seconds, latencies = run_timed(lambda x: compress(stage_args, x), paths, 1)
+                result = get_result('codec', 1, args.count, args.count * args.size, seconds, latencies)
+                output = os.path.join(working_dir, 'xz')
+                result.update({'codec': codec, 'compressibility': compressibility,
+                               'ratio': round(sum(os.path.getsize(os.path.join(output, x))
+                                                  for x in os.listdir(output)) / (args.count * args.size), 4),
+                               'cpu_seconds': round(sum(os.times()[:4]) - cpu_start, 3)})
+                yield result
+            finally:
+                shutil.rmtree(working_dir)
+
+
+# Encrypt the same synthetic archives serially and then with args.jobs workers
+def bench_encrypt(args):
+    for jobs in sorted({1, args.jobs}):
+        working_dir = make_working_dir(args)
+        try:
+            paths = make_archives(os.path.join(working_dir, 'xz'), args.count, args.size, 'tar.xz')
+            stage_args = argparse.Namespace(working_dir=working_dir, source='xz', destination='gpg', temp='tmp')
+            seconds, latencies = run_timed(lambda x: encrypt(stage_args, x), paths, jobs)
+            yield get_result('encrypt', jobs, args.count, args.count * args.size, seconds, latencies)
+        finally:
+            shutil.rmtree(working_dir)
+
+
+# Upload synthetic archives into a local directory bucket in parts, then stream them to a stand-in aws command
+def bench_upload(args):
+    for jobs in sorted({1, args.jobs}):
+        working_dir = make_working_dir(args)
+        try:
+            paths = make_archives(os.path.join(working_dir, 'gpg'), args.count, args.size, 'tar.xz.gpg')
+            stage_args = argparse.Namespace(working_dir=working_dir, part_size=2**20 * 64, part_jobs=4)
+            backend = DirectoryBackend(os.path.join(working_dir, 'bucket'))
+            state_dir = os.path.join(working_dir, 'uploads')
+            seconds, latencies = run_timed(lambda x: upload(stage_args, backend, x, state_dir), paths, jobs)
+            yield get_result('upload', jobs, args.count, args.count * args.size, seconds, latencies)
+        finally:
+            shutil.rmtree(working_dir)
+
+    working_dir = make_working_dir(args)
+    path = os.environ['PATH']
+    try:
+        paths = make_archives(os.path.join(working_dir, 'gpg'), args.count, args.size, 'tar.xz.gpg')
+        bin_path = os.path.join(working_dir, 'bin')
+        os.makedirs(bin_path)
+        with open(os.path.join(bin_path, 'aws'), 'w') as f:
+            f.write(FAKE_AWS)
+        os.chmod(os.path.join(bin_path, 'aws'), 0o755)
+        os.environ['PATH'] = f"{bin_path}{os.pathsep}{path}"
+
+        def stream(x):
+            with open(x, 'rb') as f:
+                upload_stream(f, os.path.basename(x), 's3://benchmark-bucket')
+
+        seconds, latencies = run_timed(stream, paths, 1)
+        yield get_result('upload-stream', 1, args.count, args.count * args.size, seconds, latencies)
+    finally:
+        os.environ['PATH'] = path
+        shutil.rmtree(working_dir)
+
+
+# Upload synthetic archives through the scheduler on a simulated clock from 18:00 until every one is uploaded
+# Reports the simulated hours taken, the bytes sent outside the windows and the parts still sending when a window
+# ended, which should both be none, and the most any hour sent as a fraction of its rate limit, counting each part
+# in the hour it started
+def bench_schedule(args):
+    working_dir = make_working_dir(args)
+    try:
+        source = os.path.join(working_dir, 'gpg')
+        make_archives(source, args.count, args.size, 'tar.xz.gpg')
+        start = time.mktime(time.localtime()[:3] + (18, 0, 0, 0, 0, -1))
+        clock = SimulatedClock(start)
+        scheduler = UploadScheduler(parse_windows(args.hours), args.link_speed, clock)
+        backend = SimulatedBackend(os.path.join(working_dir, 'bucket'), clock, args.link_speed)
+        stage_args = argparse.Namespace(working_dir=working_dir, jobs=1, part_jobs=1, part_size=MIN_PART_SIZE)
+        state_dir = os.path.join(working_dir, 'uploads')
+
+        begin = time.monotonic()
+        while os.listdir(source) and clock.time() < start + 30 * 24 * 3600:
+            scheduler.wait_for_window()
+            upload_all(stage_args, backend, source, state_dir, scheduler)
+        seconds = time.monotonic() - begin
+
+        hours = {}
+        for sent, _, size in backend.sent:
+            hour = get_hour_start(sent)
+            hours[hour] = hours.get(hour, 0) + size
+        limited = [hours[x] / 3600 / scheduler.get_rate(x) for x in hours if scheduler.get_rate(x)]
+        result = get_result('schedule', 1, args.count, args.count * args.size, seconds)
+        result.update({'simulated_hours': round((clock.time() - start) / 3600, 2), 'left': len(os.listdir(source)),
+                       'bytes_outside_windows': sum(x[2] for x in backend.sent if not scheduler.is_open(x[0])),
+                       'parts_past_window_end': len([x for x in backend.sent
+                                                     if scheduler.get_window_end(x[0]) is not None
+                                                     and x[1] > scheduler.get_window_end(x[0])]),
+                       'peak_rate_fraction': round(max(limited), 3) if limited else None})
+        yield result
+    finally:
+        shutil.rmtree(working_dir)
+
+
+BENCHMARKS = {
+    'archive': bench_archive,
+    'size': bench_size,
+    'compress': bench_compress,
+    'codec': bench_codec,
+    'encrypt': bench_encrypt,
+    'upload': bench_upload,
+    'schedule': bench_schedule,
+}
+
+
+if __name__ == '__main__':
+    main()
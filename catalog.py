@@ -0,0 +1,115 @@
+import argparse
+import logging
+import os
+import sqlite3
+import time
+
+# Partitions are archived by processes all writing the one catalog, so each waits this many seconds for the others
+BUSY_TIMEOUT = 600
+
+
+parser = argparse.ArgumentParser(description='Find which archives hold a path.')
+parser.add_argument('catalog', type=os.path.abspath,
+                    help='catalog file, either catalog.sqlite in the working directory or a shipped copy')
+parser.add_argument('path', help='file or directory to look for, a directory matches everything under it')
+
+
+def main():
+    args = parser.parse_args()
+    assert os.path.isfile(args.catalog)
+    catalog = Catalog(args.catalog)
+    for path, archive, size, mtime, offset, reference in catalog.find(args.path.rstrip('/') or '/'):
+        line = f"{archive}\t{offset}\t{size}\t{time.strftime('%Y-%m-%d', time.localtime(mtime))}\t{path}"
+        print(line if reference is None else f"{line}\tcopy of {reference}")
+    catalog.close()
+
+
+# Every member written to every archive, with its offset in the uncompressed tar, so finding a file is one lookup
+# A file left out of the archives as a copy of a member already archived has a row of its own at that member's
+# archive and offset, referencing the member's path
+class Catalog:
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS members (path TEXT NOT NULL, archive TEXT NOT NULL, "
+                                "size INTEGER NOT NULL, mtime INTEGER NOT NULL, offset INTEGER NOT NULL, "
+                                "PRIMARY KEY (path, archive)) WITHOUT ROWID")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS members_archive ON members (archive)")
+
+        # References were added later, so bring older catalogs up to date
+        if 'reference' not in [x[1] for x in self.connection.execute("PRAGMA table_info(members)")]:
+            self.connection.execute("ALTER TABLE members ADD COLUMN reference TEXT")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS shipped (time REAL NOT NULL)")
+
+        # Count the time until the first copy is due from when the catalog is created
+        if self.connection.execute("SELECT COUNT(*) FROM shipped").fetchone()[0] == 0:
+            self.connection.execute("INSERT INTO shipped (time) VALUES (?)", (time.time(),))
+        self.connection.commit()
+
+    # Record the members of an archive as (path, size, mtime, offset)
+    def record(self, archive, members):
+        self.connection.executemany("INSERT OR REPLACE INTO members (path, archive, size, mtime, offset) "
+                                    "VALUES (?, ?, ?, ?, ?)",
+                                    [(path, archive, size, mtime, offset) for path, size, mtime, offset in members])
+        self.connection.commit()
+
+    # Record files left out of archives as copies of members already recorded, as (path, size, mtime, member path,
+    # member archive). Members archived before the catalog was kept cannot be found, so are left out with a warning.
+    def record_references(self, references):
+        rows = []
+        for path, size, mtime, reference, archive in references:
+            row = self.connection.execute("SELECT offset FROM members WHERE path = ? AND archive = ? "
+                                          "AND reference IS NULL", (reference, archive)).fetchone()
+            if row is None:
+                logging.warning(f"{self}: {path} is a copy of {reference} in {archive}, which is not in the catalog")
+                continue
+            rows.append((path, archive, size, mtime, row[0], reference))
+        self.connection.executemany("INSERT OR REPLACE INTO members (path, archive, size, mtime, offset, reference) "
+                                    "VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.connection.commit()
+
+    # Return (path, archive, size, mtime, offset, reference) of every member at or under path, oldest archive first
+    # Reference is the path of the member holding the data of a file left out as a copy of it, otherwise None
+    def find(self, path):
+        prefix = path.rstrip('/') + '/'
+        return self.connection.execute("SELECT path, archive, size, mtime, offset, reference FROM members "
+                                       "WHERE path = ? OR (path >= ? AND path < ?) ORDER BY archive, path",
+                                       (path, prefix, prefix[:-1] + chr(ord('/') + 1))).fetchall()
+
+    # Return the rows of the volumes of a file split across archives, named for the file with a part number
+    def find_volumes(self, path):
+        prefix = path.rstrip('/') + '.part'
+        return self.connection.execute("SELECT path, archive, size, mtime, offset, reference FROM members "
+                                       "WHERE path >= ? AND path < ? ORDER BY path",
+                                       (prefix, prefix[:-1] + chr(ord('t') + 1))).fetchall()
+
+    # Return True if no copy has been shipped in the last days days
+    def is_due(self, days):
+        last = self.connection.execute("SELECT MAX(time) FROM shipped").fetchone()[0]
+        return last is None or time.time() - last > days * 24 * 3600
+
+    # The number of copies written so far, which names the next one
+    def count_shipped(self):
+        return self.connection.execute("SELECT COUNT(*) FROM shipped").fetchone()[0]
+
+    # Write a consistent copy of the catalog to path and note when it was made
+    def ship(self, path):
+        self.connection.execute("INSERT INTO shipped (time) VALUES (?)", (time.time(),))
+        self.connection.commit()
+        copy = sqlite3.connect(path)
+        try:
+            self.connection.backup(copy)
+        finally:
+            copy.close()
+        logging.debug(f"{self}: copied to {path}")
+
+    def close(self):
+        self.connection.close()
+
+    def __str__(self):
+        return f"Catalog {os.path.basename(self.path)}"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import json
+import logging
+import os
+
+# Suffixes the stages add to the name of an archive, in the order they are taken off again
+SUFFIXES = ('.gpg', '.xz', '.zst')
+
+
+# The name of the archive a file of any stage came from
+def get_archive_name(name):
+    for suffix in SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+
+# Every file an archive becomes on its way through the pipeline has its checksum in checksums/<archive>.json
+def get_checksums_path(working_dir, name):
+    return os.path.join(working_dir, "checksums", f"{get_archive_name(name)}.json")
+
+
+def load_checksums(working_dir, name):
+    path = get_checksums_path(working_dir, name)
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+# Note the sha256 and size of a file as a stage wrote it
+# The stages of one archive run one after another, so its manifest is never written by two at once
+def record_checksum(working_dir, name, sha256, size):
+    checksums = load_checksums(working_dir, name)
+    checksums[name] = dict(sha256=sha256, size=size)
+    path = get_checksums_path(working_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(checksums, f)
+    os.rename(f"{path}.tmp", path)
+
+
+# Forget the checksums of an archive once the last stage has uploaded it and checked the upload
+def remove_checksums(working_dir, name):
+    path = get_checksums_path(working_dir, name)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+# Raise if the file at path was read as anything other than what the stage before wrote
+# Files written before checksums were kept, and files no stage wrote such as catalog copies, have none to check
+def verify_checksum(working_dir, path, sha256, size):
+    name = os.path.basename(path)
+    recorded = load_checksums(working_dir, name).get(name)
+    if recorded is None:
+        logging.debug(f"no checksum recorded for {name}")
+        return
+    if (recorded['sha256'], recorded['size']) != (sha256, size):
+        raise Exception(f"{name} was read with sha256 {sha256} and size {size} but was written with sha256 "
+                        f"{recorded['sha256']} and size {recorded['size']}")
@@ -1,9 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import hashlib
 from logging import handlers
 import os
 import random
 import string
 import subprocess
+import time
+
+from ledger import update_usage
+from metrics import record_metrics
 
 
 def convert_tgmk(value):
@@ -31,6 +37,46 @@ def convert_tgmk(value):
     return int(eval(value))
 
 
+# Copy src to dst in chunks until src is exhausted, returning the number of bytes copied
+def copy_stream(src, dst, chunk_size=2**20):
+    total = 0
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            return total
+        dst.write(chunk)
+        total += len(chunk)
+
+
+# Convert a path into a file name prefix by changing slashes to dots
+def get_dotted_name(path):
+    name = path.replace('/', '.').replace('\\', '.')
+    while name[0] == ".":
+        name = name[1:]
+    return name
+
+
+# Quick hash of the start and end of a file, used to find files that may be copies before hashing them fully
+def get_prehash(path, size, sample_size=2**16):
+    prehash = hashlib.blake2b(str(size).encode())
+    with open(path, 'rb') as f:
+        prehash.update(f.read(sample_size))
+        if size > sample_size:
+            f.seek(max(sample_size, size - sample_size))
+            prehash.update(f.read(sample_size))
+    return prehash.hexdigest()
+
+
+def get_file_hash(path):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(2**20)
+            if not chunk:
+                return file_hash.hexdigest()
+            file_hash.update(chunk)
+
+
 def get_filename_range_descriptor(first_item, last_item, directory_list):
 
     # Get the starting range
@@ -90,8 +136,100 @@ def get_temp_file_name():
                            for _ in range(16))
 
 
-def report(working_dir, line):
+# File reader that hashes everything read through it
+class HashingReader:
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        self.size += len(data)
+        return data
+
+
+# File writer that hashes everything written through it, which can be rolled back to an earlier offset
+class HashingWriter:
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.name = getattr(fileobj, 'name', None)
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def tell(self):
+        return self.size
+
+    def seekable(self):
+        return self.fileobj.seekable()
+
+    # Drop everything written after offset, restoring the hash taken when that was the size
+    def rollback(self, offset, file_hash):
+        self.fileobj.seek(offset)
+        self.fileobj.truncate()
+        self.hash = file_hash
+        self.size = offset
+
+    def close(self):
+        self.fileobj.close()
+
+
+# Run command with the file at path on its standard input and its standard output written to output_path,
+# hashing the bytes on both pipes as they pass so neither file has to be read again to check it
+# Returns the input and output readers, which hold the hash and size of each
+def run_hashed(command, path, output_path, timer=None):
+    with open(path, 'rb') as src, open(output_path, 'wb') as dst, ThreadPoolExecutor(max_workers=1) as pool:
+        child = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        source = HashingReader(src)
+        output = HashingReader(child.stdout)
+        fed = pool.submit(feed_stream, source, child.stdin)
+        try:
+            copy_stream(output, dst)
+        # Killing the command closes its input, so the thread feeding it stops too
+        except BaseException:
+            child.kill()
+            raise
+        finally:
+            child.stdout.close()
+            if timer is not None:
+                timer.wait(child)
+            else:
+                child.wait()
+
+        if child.returncode != 0:
+            raise Exception(f"command '{' '.join(command)}' failed with return code {child.returncode}")
+        cpu = fed.result()
+        if timer is not None:
+            timer.add_cpu(cpu)
+    return source, output
+
+
+# Copy src into dst and close it, returning the CPU seconds this thread spent
+def feed_stream(src, dst):
+    start = time.thread_time()
+    try:
+        copy_stream(src, dst)
+    finally:
+        dst.close()
+    return time.thread_time() - start
+
+
+# Log a line to the central log, and record any change in the bytes held by each stage folder
+# and any structured record of the item's time through its stage
+def report(working_dir, line, usage=None, record=None):
     report_path = os.path.join(working_dir, "archiver.log")
     timestamp = datetime.today().strftime('%Y%m%dT%H%M%S')
     with open(report_path, 'a') as f:
         f.write(f"{timestamp} {line}\n")
+    if usage is not None:
+        update_usage(working_dir, usage)
+    if record is not None:
+        record_metrics(working_dir, record)
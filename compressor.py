@@ -1,10 +1,34 @@
 import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import logging
 import logging.handlers
+import math
 import os
+import shutil
 import subprocess
+import zlib
 
-from common import get_size, get_smtp_handler, report
+from checksums import record_checksum, verify_checksum
+from common import get_smtp_handler, report, run_hashed
+from metrics import STAGE_QUEUES, StageTimer
+
+# xz's own block size at the default preset, which is already small enough to keep every thread busy
+DEFAULT_BLOCK_SIZE = 3 * 8 * 2**20
+MIN_BLOCK_SIZE = 2**20
+
+# Suffix each codec adds to the file name, which is how a restore knows how to decode it
+CODEC_SUFFIXES = {'xz': '.xz', 'zstd': '.zst', 'store': ''}
+
+# Samples taken across a file to choose its codec, and the fraction of their size a fast deflate has to leave
+# for a codec to be chosen. Data that barely compresses is stored, data that compresses a little gets zstd.
+SAMPLE_COUNT = 16
+SAMPLE_SIZE = 2**20
+STORE_RATIO = 0.95
+ZSTD_RATIO = 0.8
+
+# zstd level, and window for long range matching, which zstd decodes without being told
+ZSTD_LEVEL = 9
+ZSTD_WINDOW_LOG = 27
 
 
 parser = argparse.ArgumentParser(description='Compress the files in the source directory.')
@@ -12,7 +36,10 @@ parser.add_argument('working_dir', type=os.path.abspath, help='archiver working
 parser.add_argument('--source', default="tar", help='source folder name')
 parser.add_argument('--destination', default="xz", help='destination folder name')
 parser.add_argument('--temp', default="tmp", help='temporary folder name')
-parser.add_argument('-t', '--threads', default="1", help='threads to use for compression')
+parser.add_argument('-t', '--threads', default="1", help='threads to use for compression, shared by all jobs')
+parser.add_argument('-j', '--jobs', default=1, type=int, help='number of files to compress at once')
+parser.add_argument('--codec', default='auto', choices=['auto'] + list(CODEC_SUFFIXES),
+                    help='codec to compress with, or auto to choose for each file from samples of it')
 parser.add_argument('-d', '--debug', action='store_true', help='enable debug logging')
 
 
@@ -41,13 +68,11 @@ def main():
 
         source_path = os.path.join(args.working_dir, args.source)
         while True:
-            archive_list = [x for x in os.listdir(source_path) if x.endswith('tar') or x.endswith('txt')]
+            archive_list = [x for x in os.listdir(source_path) if x.endswith(STAGE_QUEUES['compress'][1])]
             if len(archive_list) == 0:
                 break
 
-            for archive in archive_list:
-                product = compress(args, os.path.join(source_path, archive))
-                report(args.working_dir, f"compressed {os.path.basename(product)} {get_size(product)}")
+            compress_all(args, [os.path.join(source_path, x) for x in archive_list])
 
         logging.debug(f"compressor ending")
     except subprocess.CalledProcessError as e:
@@ -58,27 +83,81 @@ def main():
         exit(1)
 
 
+# Compress the listed files, running up to args.jobs at once and splitting args.threads cores between them
+def compress_all(args, paths):
+    pending = sorted(((os.path.getsize(x), x) for x in paths), reverse=True)
+    running = {}
+    free_threads = args.threads
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        while pending or running:
+
+            # Start jobs while there are free cores, giving each a share in proportion to its size
+            # while leaving at least one core for each of the other jobs that could start now
+            while pending and len(running) < args.jobs and (free_threads > 0 or not running):
+                size, path = pending.pop(0)
+                upcoming = [size] + [x[0] for x in pending[:args.jobs - len(running) - 1]]
+                threads = round(free_threads * size / max(sum(upcoming), 1))
+                threads = max(1, min(free_threads - len(upcoming) + 1, threads))
+                free_threads -= threads
+                running[pool.submit(timed_compress, args, path, threads)] = threads
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                free_threads += running.pop(future)
+                report_compressed(args.working_dir, *future.result())
+
+
+# Compress path and return the product, the bytes read and the timer of the work
+def timed_compress(args, path, threads):
+    size = os.path.getsize(path)
+    timer = StageTimer('compress')
+    product = compress(args, path, threads, timer)
+    return product, size, timer
+
+
+def report_compressed(working_dir, product, size, timer):
+    rate = size / max(timer.get_seconds(), 1e-6) / 2**20
+    product_size = os.path.getsize(product)
+    name = os.path.basename(product)
+    report(working_dir, f"compressed {name} {product_size} {rate:.1f}MB/s", {'tar': -size, 'xz': product_size},
+           timer.get_record(name, size, product_size))
+
+
 # Function returns True when it has successfully created the next archive file
-def compress(args, path):
+def compress(args, path, threads=None, timer=None):
     logging.debug(f"Starting compress of file {path}")
+    if threads is None:
+        threads = args.threads
+    codec = args.codec
+    if codec == 'auto':
+        codec = choose_codec(path)
 
     # Calculate the resulting filename
-    filename = f"{os.path.basename(path)}.xz"
+    filename = f"{os.path.basename(path)}{CODEC_SUFFIXES[codec]}"
     tmp_path = os.path.join(args.working_dir, args.temp, filename)
     assert not os.path.isfile(tmp_path)
     xz_path = os.path.join(args.working_dir, args.destination, filename)
     assert not os.path.isfile(xz_path)
 
-    # Compress, well, on 4 threads
-    command = ['xz', '-z', '-c', f'-T {args.threads}', path]
-    try:
-        with open(tmp_path, 'w') as f:
-            child = subprocess.Popen(command, stdout=f)
-            child.wait()
+    # A file not worth compressing moves on as it is
+    if codec == 'store':
+        os.rename(path, xz_path)
+        logging.debug(f"Stored {filename} without compression")
+        return xz_path
 
-            if child.returncode != 0:
-                raise Exception(f"command '{' '.join(command)}' failed with return code {child.returncode}")
-    except subprocess.CalledProcessError as e:
+    # The file is fed to the compressor through a pipe, so what it compresses can be checked against what was written
+    if codec == 'zstd':
+        command = get_zstd_command(threads)
+    else:
+        # Give every thread at least one block to work on, so small files still compress in parallel
+        block_size = max(MIN_BLOCK_SIZE, min(DEFAULT_BLOCK_SIZE, math.ceil(os.path.getsize(path) / threads)))
+        command = get_compress_command(threads, block_size=block_size)
+    try:
+        source, output = run_hashed(command, path, tmp_path, timer)
+        verify_checksum(args.working_dir, path, source.hash.hexdigest(), source.size)
+        record_checksum(args.working_dir, filename, output.hash.hexdigest(), output.size)
+    except Exception as e:
         if os.path.isfile(tmp_path):
             os.remove(tmp_path)
         raise e
@@ -92,5 +171,49 @@ def compress(args, path):
     return xz_path
 
 
+# Pick a codec for path by how well samples from across it compress with a fast deflate
+# Small files get fewer samples, so that no part of a file is sampled twice
+def choose_codec(path):
+    size = os.path.getsize(path)
+    count = max(1, min(SAMPLE_COUNT, size // SAMPLE_SIZE))
+    sampled = 0
+    compressed = 0
+    with open(path, 'rb') as f:
+        for i in range(count):
+            f.seek(max(0, size - SAMPLE_SIZE) * i // max(1, count - 1))
+            data = f.read(SAMPLE_SIZE)
+            sampled += len(data)
+            compressed += len(zlib.compress(data, 1))
+
+    ratio = compressed / max(sampled, 1)
+    if ratio >= STORE_RATIO:
+        codec = 'store'
+    elif ratio >= ZSTD_RATIO and shutil.which('zstd') is not None:
+        codec = 'zstd'
+    else:
+        codec = 'xz'
+    logging.debug(f"samples of {path} compress to {ratio:.2f} so using {codec}")
+    return codec
+
+
+# Command to compress path, or standard input when path is None, with zstd to standard output
+# Matching is over a long window for large archives
+def get_zstd_command(threads, path=None):
+    command = ['zstd', '-c', '-q', f'-{ZSTD_LEVEL}', f'-T{threads}', f'--long={ZSTD_WINDOW_LOG}']
+    if path is not None:
+        command.append(path)
+    return command
+
+
+# Command to compress path, or standard input when path is None, to standard output
+def get_compress_command(threads, path=None, block_size=None):
+    command = ['xz', '-z', '-c', f'-T {threads}']
+    if block_size is not None:
+        command.append(f'--block-size={block_size}')
+    if path is not None:
+        command.append(path)
+    return command
+
+
 if __name__ == '__main__':
     main()
@@ -1,16 +1,20 @@
 import argparse
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 import logging
 import logging.handlers
 import os
 import subprocess
 
-from common import get_size, get_smtp_handler, report
+from checksums import record_checksum, verify_checksum
+from common import get_smtp_handler, report, run_hashed
+from metrics import STAGE_QUEUES, StageTimer
 
 parser = argparse.ArgumentParser(description='Encrypt the files in xz folder in the destination.')
 parser.add_argument('working_dir', type=os.path.abspath, help='archiver working directory')
 parser.add_argument('--source', default="xz", help='source folder name')
 parser.add_argument('--destination', default="gpg", help='destination folder name')
 parser.add_argument('--temp', default="tmp", help='temporary folder name')
+parser.add_argument('-j', '--jobs', default=1, type=int, help='number of files to encrypt at once')
 parser.add_argument('-d', '--debug', action='store_true', help='enable debug logging')
 
 
@@ -38,13 +42,11 @@ def main():
 
         archive_path = os.path.join(args.working_dir, args.source)
         while True:
-            archive_list = [x for x in os.listdir(archive_path) if x.endswith('xz')]
+            archive_list = [x for x in os.listdir(archive_path) if x.endswith(STAGE_QUEUES['encrypt'][1])]
             if len(archive_list) == 0:
                 break
 
-            for archive in archive_list:
-                product = encrypt(args, os.path.join(archive_path, archive))
-                report(args.working_dir, f"encrypted {os.path.basename(product)} {get_size(product)}")
+            encrypt_all(args, [os.path.join(archive_path, x) for x in archive_list])
 
         logging.debug(f"encrypter ending")
     except subprocess.CalledProcessError as e:
@@ -55,8 +57,46 @@ def main():
         exit(1)
 
 
+# Encrypt the listed files, running up to args.jobs gpg processes at once
+def encrypt_all(args, paths):
+    error = None
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(timed_encrypt, args, x) for x in paths]
+        for future in futures:
+            try:
+                product, size, timer = future.result()
+            except CancelledError:
+                continue
+
+            # Do not start anything new after a failure, but let running jobs finish or clean up after themselves
+            except Exception as e:
+                if error is None:
+                    error = e
+                    pool.shutdown(wait=False, cancel_futures=True)
+                continue
+            report_encrypted(args.working_dir, product, size, timer)
+
+    if error is not None:
+        raise error
+
+
+# Encrypt path and return the product, the bytes read and the timer of the work
+def timed_encrypt(args, path):
+    size = os.path.getsize(path)
+    timer = StageTimer('encrypt')
+    product = encrypt(args, path, timer)
+    return product, size, timer
+
+
+def report_encrypted(working_dir, product, size, timer):
+    product_size = os.path.getsize(product)
+    name = os.path.basename(product)
+    report(working_dir, f"encrypted {name} {product_size}", {'xz': -size, 'gpg': product_size},
+           timer.get_record(name, size, product_size))
+
+
 # Function encrypts the passed file returning the new name or raises an exception
-def encrypt(args, path):
+def encrypt(args, path, timer=None):
     logging.debug(f"Starting encryption of file {path}")
 
     # Calculate the resulting filename
@@ -66,17 +106,13 @@ def encrypt(args, path):
     gpg_path = os.path.join(args.working_dir, args.destination, filename)
     assert not os.path.isfile(gpg_path)
 
-    # Specify the command to encrypt
-    command = ['gpg', '-c', '--cipher-algo', 'AES256', '--batch',
-               '--passphrase-file', os.path.join(args.working_dir, 'passphrase.txt'),
-               '--output', tmp_path, path]
+    # Specify the command to encrypt, fed through pipes so what it encrypts can be checked against what was written
+    command = get_encrypt_command(args.working_dir, '-')
     try:
-        child = subprocess.Popen(command)
-        child.wait()
-
-        if child.returncode != 0:
-            raise Exception(f"command '{' '.join(command)}' failed with return code {child.returncode}")
-    except subprocess.CalledProcessError as e:
+        source, output = run_hashed(command, path, tmp_path, timer)
+        verify_checksum(args.working_dir, path, source.hash.hexdigest(), source.size)
+        record_checksum(args.working_dir, filename, output.hash.hexdigest(), output.size)
+    except Exception as e:
         if os.path.isfile(tmp_path):
             os.remove(tmp_path)
         raise e
@@ -90,5 +126,20 @@ def encrypt(args, path):
     return gpg_path
 
 
+# Command to encrypt path, or standard input when path is None, into output which may be '-' for standard output
+def get_encrypt_command(working_dir, output, path=None):
+    command = ['gpg', '-c', '--cipher-algo', 'AES256', '--batch',
+               '--passphrase-file', os.path.join(working_dir, 'passphrase.txt'),
+               '--output', output]
+    if path is not None:
+        command.append(path)
+    return command
+
+
+# Command to decrypt path into output with the passphrase in passphrase_path
+def get_decrypt_command(passphrase_path, output, path):
+    return ['gpg', '-d', '--batch', '--yes', '--quiet', '--passphrase-file', passphrase_path, '--output', output, path]
+
+
 if __name__ == '__main__':
     main()
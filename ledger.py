@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+import time
+
+# Folders of the working directory whose contents are counted in the ledger
+STAGE_FOLDERS = ('tar', 'xz', 'gpg')
+
+# Recount the folders at least this often in case something has changed them without updating the ledger
+RECOUNT_SECONDS = 24 * 3600
+
+
+# Open the working directory's ledger of bytes held in each stage folder, locked against the other stages
+@contextmanager
+def open_ledger(working_dir):
+    with open(os.path.join(working_dir, "usage.json"), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        text = f.read()
+        ledger = json.loads(text) if text else count_usage(working_dir)
+        yield ledger
+        f.seek(0)
+        f.truncate()
+        json.dump(ledger, f)
+
+
+# Add the byte changes, such as {'tar': -100, 'xz': 40}, to the ledger
+def update_usage(working_dir, changes):
+    with open_ledger(working_dir) as ledger:
+        for folder, change in changes.items():
+            ledger[folder] = ledger.get(folder, 0) + change
+
+
+# Return the bytes held in the stage folders, recounting them only if the ledger looks wrong
+def get_usage(working_dir):
+    with open_ledger(working_dir) as ledger:
+        if is_drifted(working_dir, ledger):
+            logging.debug(f"usage ledger {ledger} has drifted, recounting")
+            ledger.update(count_usage(working_dir))
+        return sum(ledger.get(x, 0) for x in STAGE_FOLDERS)
+
+
+# Return the bytes available to us on the working directory's filesystem
+def get_free_space(working_dir):
+    stat = os.statvfs(working_dir)
+    return stat.f_bavail * stat.f_frsize
+
+
+# The ledger is wrong if it is old, has gone negative, or holds more than the whole filesystem has in use
+def is_drifted(working_dir, ledger):
+    if time.time() - ledger.get('counted', 0) > RECOUNT_SECONDS:
+        return True
+    if any(ledger.get(x, 0) < 0 for x in STAGE_FOLDERS):
+        return True
+    stat = os.statvfs(working_dir)
+    return sum(ledger.get(x, 0) for x in STAGE_FOLDERS) > (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+
+
+# Count the bytes in each stage folder from scratch
+def count_usage(working_dir):
+    usage = {'counted': time.time()}
+    for folder in STAGE_FOLDERS:
+        usage[folder] = 0
+        path = os.path.join(working_dir, folder)
+        if not os.path.isdir(path):
+            continue
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    usage[folder] += entry.stat(follow_symlinks=False).st_size
+    return usage
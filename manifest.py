@@ -0,0 +1,96 @@
+import logging
+import os
+import sqlite3
+import time
+
+
+# Record of every file archived, used to find what has changed since for an incremental backup
+class Manifest:
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                                "mtime INTEGER NOT NULL, inode INTEGER NOT NULL, archive TEXT, "
+                                "seen INTEGER NOT NULL, deleted INTEGER)")
+
+        # Content hashes were added later, so bring older manifests up to date
+        columns = [x[1] for x in self.connection.execute("PRAGMA table_info(files)")]
+        for column in ('prehash', 'sha256', 'reference'):
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE files ADD COLUMN {column} TEXT")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_content ON files (size, prehash)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS passes (number INTEGER PRIMARY KEY, "
+                                "incremental INTEGER NOT NULL, started REAL NOT NULL, finished REAL)")
+        self.connection.commit()
+
+        # The pass over the source that is in progress, if any
+        self.number = None
+        self.incremental = False
+        row = self.connection.execute("SELECT number, incremental FROM passes WHERE finished IS NULL").fetchone()
+        if row is not None:
+            self.number, self.incremental = row[0], bool(row[1])
+
+    # Begin a new walk of the whole source
+    def start_pass(self, incremental):
+        self.number = self.connection.execute("INSERT INTO passes (incremental, started) VALUES (?, ?)",
+                                              (int(incremental), time.time())).lastrowid
+        self.incremental = incremental
+        self.connection.commit()
+        logging.debug(f"{self}: started {'incremental' if incremental else 'full'} pass {self.number}")
+
+    # End the current pass, returning the files an incremental pass did not find as deleted
+    def finish_pass(self):
+        deleted = []
+        if self.incremental:
+            deleted = [x for (x,) in self.connection.execute(
+                "SELECT path FROM files WHERE seen < ? AND deleted IS NULL ORDER BY path", (self.number,))]
+            self.connection.execute("UPDATE files SET deleted = ? WHERE seen < ? AND deleted IS NULL",
+                                    (self.number, self.number))
+        self.connection.execute("UPDATE passes SET finished = ? WHERE number = ?", (time.time(), self.number))
+        self.connection.commit()
+        logging.debug(f"{self}: finished pass {self.number} with {len(deleted)} deleted files")
+        self.number = None
+        self.incremental = False
+        return deleted
+
+    # Return True if the file at path is not in the manifest as it is now
+    def is_changed(self, path, stat):
+        row = self.connection.execute("SELECT size, mtime, inode, deleted FROM files WHERE path = ?",
+                                      (path,)).fetchone()
+        return row is None or row[3] is not None or row[:3] != (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    # Note that unchanged files still exist, so they are not taken as deleted at the end of the pass
+    def mark_seen(self, paths):
+        self.connection.executemany("UPDATE files SET seen = ? WHERE path = ?", [(self.number, x) for x in paths])
+        self.connection.commit()
+
+    # Return (sha256, path, archive) for each archived copy that could hold the same content
+    def get_copies(self, size, prehash):
+        return self.connection.execute("SELECT sha256, COALESCE(reference, path), archive FROM files "
+                                       "WHERE size = ? AND prehash = ? AND sha256 IS NOT NULL",
+                                       (size, prehash)).fetchall()
+
+    # Record the files written to an archive as (path, stat, prehash) with their content hashes by path
+    def record(self, files, archive, hashes):
+        self.connection.executemany("INSERT OR REPLACE INTO files (path, size, mtime, inode, archive, seen, deleted, "
+                                    "prehash, sha256, reference) VALUES (?, ?, ?, ?, ?, ?, NULL, ?, ?, NULL)",
+                                    [(path, stat.st_size, stat.st_mtime_ns, stat.st_ino, archive, self.number,
+                                      prehash, hashes.get(path)) for path, stat, prehash in files])
+        self.connection.commit()
+
+    # Record files left out of an archive because a copy is already archived, so a restore takes them from the copy
+    # Each is (path, stat, prehash, sha256, copy path, copy archive), where a copy archive of None means this archive
+    def record_references(self, references, archive):
+        self.connection.executemany("INSERT OR REPLACE INTO files (path, size, mtime, inode, archive, seen, deleted, "
+                                    "prehash, sha256, reference) VALUES (?, ?, ?, ?, ?, ?, NULL, ?, ?, ?)",
+                                    [(path, stat.st_size, stat.st_mtime_ns, stat.st_ino, copy_archive or archive,
+                                      self.number, prehash, sha256, copy_path)
+                                     for path, stat, prehash, sha256, copy_path, copy_archive in references])
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __str__(self):
+        return f"Manifest {os.path.basename(self.path)}"
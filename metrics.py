@@ -0,0 +1,165 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import time
+
+from ledger import open_ledger
+
+# Stages in pipeline order, with the working directory folder and file suffixes each takes its work from
+# Every stage and the supervisor pick up work by these suffixes, so they are only listed here
+STAGES = ('archive', 'compress', 'encrypt', 'upload')
+STAGE_QUEUES = {
+    'compress': ('tar', ('tar', 'txt', 'sqlite')),
+    'encrypt': ('xz', ('xz', 'zst', 'tar', 'txt', 'sqlite')),
+    'upload': ('gpg', ('gpg',)),
+}
+
+# Throughput is measured over this many of the most recent items through each stage
+RECENT_ITEMS = 20
+
+
+# A structured record of one item through a stage
+def get_record(stage, name, start, end, bytes_in, bytes_out, cpu):
+    return {'stage': stage, 'name': name, 'start': round(start, 3), 'end': round(end, 3), 'bytes_in': bytes_in,
+            'bytes_out': bytes_out, 'wall': round(end - start, 3), 'cpu': round(cpu, 3)}
+
+
+# Times one item through a stage in wall clock seconds and CPU seconds, counting child processes waited for
+class StageTimer:
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = time.time()
+        self.thread_start = time.thread_time()
+        self.child_cpu = 0
+
+    # Wait for a child process to exit like Popen.wait, adding the CPU it used
+    # A process already reaped, such as by Popen.kill, is waited for without counting its CPU
+    def wait(self, child):
+        if child.returncode is None:
+            try:
+                _, status, usage = os.wait4(child.pid, 0)
+            except ChildProcessError:
+                return child.wait()
+            child.returncode = os.waitstatus_to_exitcode(status)
+            self.child_cpu += usage.ru_utime + usage.ru_stime
+        return child.returncode
+
+    # Add CPU used for this item on other threads
+    def add_cpu(self, seconds):
+        self.child_cpu += seconds
+
+    def get_seconds(self):
+        return time.time() - self.start
+
+    def get_record(self, name, bytes_in, bytes_out):
+        cpu = time.thread_time() - self.thread_start + self.child_cpu
+        return get_record(self.stage, name, self.start, time.time(), bytes_in, bytes_out, cpu)
+
+
+# Open the working directory's running totals for each stage, locked against the other stages
+@contextmanager
+def open_metrics(working_dir):
+    with open(os.path.join(working_dir, "metrics.json"), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        text = f.read()
+        metrics = json.loads(text) if text else {}
+        yield metrics
+        f.seek(0)
+        f.truncate()
+        json.dump(metrics, f)
+
+
+# Append a record to metrics.jsonl, add it to the running totals and rewrite the Prometheus textfile
+def record_metrics(working_dir, record):
+    with open(os.path.join(working_dir, "metrics.jsonl"), 'a') as f:
+        f.write(f"{json.dumps(record)}\n")
+
+    with open_metrics(working_dir) as metrics:
+        stage = metrics.setdefault(record['stage'], {'items': 0, 'bytes_in': 0, 'bytes_out': 0, 'wall': 0, 'cpu': 0,
+                                                     'recent': []})
+        stage['items'] += 1
+        for key in ('bytes_in', 'bytes_out', 'wall', 'cpu'):
+            stage[key] += record[key]
+        stage['recent'] = stage['recent'][-(RECENT_ITEMS - 1):] + [[record['start'], record['end'],
+                                                                    record['bytes_in']]]
+        write_prometheus(working_dir, get_status(working_dir, metrics))
+
+
+# Return bytes per second over the recent items, counting only time in which at least one was in progress
+def get_throughput(recent):
+    busy = 0
+    busy_end = 0
+    for start, end, _ in sorted(recent):
+        if end > busy_end:
+            busy += end - max(start, busy_end)
+            busy_end = end
+    if busy <= 0:
+        return None
+    return sum(x[2] for x in recent) / busy
+
+
+# Summarize each stage's backlog, totals, recent throughput and time to clear its backlog at that rate
+def get_status(working_dir, metrics=None):
+    if metrics is None:
+        with open_metrics(working_dir) as metrics:
+            pass
+    with open_ledger(working_dir) as ledger:
+        usage = dict(ledger)
+
+    status = {'time': time.time(), 'stages': {}}
+    for name in STAGES:
+        stage = metrics.get(name, {'items': 0, 'bytes_in': 0, 'bytes_out': 0, 'wall': 0, 'cpu': 0, 'recent': []})
+        summary = {key: stage[key] for key in ('items', 'bytes_in', 'bytes_out', 'wall', 'cpu')}
+        summary['bytes_per_second'] = get_throughput(stage['recent'])
+        summary['last'] = stage['recent'][-1][1] if stage['recent'] else None
+
+        if name in STAGE_QUEUES:
+            folder, suffixes = STAGE_QUEUES[name]
+            path = os.path.join(working_dir, folder)
+            listing = os.listdir(path) if os.path.isdir(path) else []
+            summary['queue_files'] = len([x for x in listing if x.endswith(suffixes)])
+            summary['queue_bytes'] = usage.get(folder, 0)
+            summary['eta'] = None
+            if summary['bytes_per_second']:
+                summary['eta'] = summary['queue_bytes'] / summary['bytes_per_second']
+        status['stages'][name] = summary
+
+    status['checkpoint'] = get_checkpoint(working_dir)
+
+    # Partitions of the source archived by workers of their own each have a checkpoint
+    status['partitions'] = {}
+    path = os.path.join(working_dir, "partitions")
+    for name in sorted(os.listdir(path)) if os.path.isdir(path) else []:
+        status['partitions'][name] = get_checkpoint(os.path.join(path, name))
+    return status
+
+
+def get_checkpoint(path):
+    checkpoint_path = os.path.join(path, "checkpoint.txt")
+    if not os.path.isfile(checkpoint_path):
+        return None
+    with open(checkpoint_path, 'r') as f:
+        return f.readline().strip()
+
+
+# Write the status as a Prometheus textfile for the node exporter to collect
+def write_prometheus(working_dir, status):
+    lines = []
+    for metric, key, kind in (('items', 'items', 'counter'), ('bytes_in', 'bytes_in', 'counter'),
+                              ('bytes_out', 'bytes_out', 'counter'), ('wall_seconds', 'wall', 'counter'),
+                              ('cpu_seconds', 'cpu', 'counter'), ('bytes_per_second', 'bytes_per_second', 'gauge'),
+                              ('queue_files', 'queue_files', 'gauge'), ('queue_bytes', 'queue_bytes', 'gauge'),
+                              ('eta_seconds', 'eta', 'gauge'), ('last_timestamp_seconds', 'last', 'gauge')):
+        name = f"archiver_stage_{metric}{'_total' if kind == 'counter' else ''}"
+        lines.append(f"# TYPE {name} {kind}")
+        for stage, summary in status['stages'].items():
+            if summary.get(key) is not None:
+                lines.append(f'{name}{{stage="{stage}"}} {summary[key]}')
+
+    path = os.path.join(working_dir, "metrics.prom")
+    with open(f"{path}.tmp", 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.rename(f"{path}.tmp", path)
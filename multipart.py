@@ -0,0 +1,262 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+import threading
+import time
+
+from common import get_temp_file_name
+
+# S3 limits on multipart uploads
+MAX_PARTS = 10000
+MIN_PART_SIZE = 5 * 2**20
+
+
+# Pick the upload backend for a destination, an S3 url or, for testing, a local directory
+def get_backend(destination):
+    if destination.startswith('s3://'):
+        return S3Backend(destination)
+    return DirectoryBackend(destination)
+
+
+# Multipart uploads into S3 through boto3, which is only needed when uploading to S3
+class S3Backend:
+
+    def __init__(self, url, storage_class='DEEP_ARCHIVE'):
+        import boto3
+        self.client = boto3.client('s3')
+        self.bucket, _, self.prefix = url[len('s3://'):].partition('/')
+        self.storage_class = storage_class
+
+    def get_key(self, name):
+        return f"{self.prefix.rstrip('/')}/{name}" if self.prefix else name
+
+    def create(self, name):
+        response = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.get_key(name),
+                                                       StorageClass=self.storage_class)
+        return response['UploadId']
+
+    def upload_part(self, name, upload_id, number, data):
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.get_key(name), UploadId=upload_id,
+                                           PartNumber=number, Body=data)
+        return response['ETag'].strip('"')
+
+    # Returns the ETag of the completed object
+    def complete(self, name, upload_id, parts):
+        parts = [{'PartNumber': number, 'ETag': etag} for number, etag in parts]
+        response = self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.get_key(name),
+                                                         UploadId=upload_id, MultipartUpload={'Parts': parts})
+        return response['ETag'].strip('"')
+
+    def abort(self, name, upload_id):
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.get_key(name), UploadId=upload_id)
+
+    def __str__(self):
+        return f"S3Backend s3://{self.bucket}/{self.prefix}"
+
+
+# Multipart uploads into a local directory, behaving like S3 so the uploader can be tested without it
+class DirectoryBackend:
+
+    def __init__(self, path):
+        self.path = path
+        self.parts_path = os.path.join(path, '.uploads')
+
+    def create(self, name):
+        upload_id = get_temp_file_name()
+        os.makedirs(os.path.join(self.parts_path, upload_id))
+        return upload_id
+
+    def upload_part(self, name, upload_id, number, data):
+        part_path = os.path.join(self.parts_path, upload_id, f"{number:05d}")
+        with open(f"{part_path}.tmp", 'wb') as f:
+            f.write(data)
+        os.rename(f"{part_path}.tmp", part_path)
+        return hashlib.md5(data).hexdigest()
+
+    # Join the parts into a temporary file so the object appears all at once
+    # Returns an ETag made from the parts as joined, the way S3 makes the ETag of a multipart object
+    def complete(self, name, upload_id, parts):
+        upload_path = os.path.join(self.parts_path, upload_id)
+        tmp_path = os.path.join(upload_path, 'complete')
+        digests = []
+        with open(tmp_path, 'wb') as f:
+            for number, _ in parts:
+                with open(os.path.join(upload_path, f"{number:05d}"), 'rb') as part:
+                    data = part.read()
+                digests.append(hashlib.md5(data).hexdigest())
+                f.write(data)
+        os.rename(tmp_path, os.path.join(self.path, name))
+        shutil.rmtree(upload_path)
+        return get_multipart_etag(digests)
+
+    def abort(self, name, upload_id):
+        shutil.rmtree(os.path.join(self.parts_path, upload_id), ignore_errors=True)
+
+    def __str__(self):
+        return f"DirectoryBackend {self.path}"
+
+
+# Local directory bucket where each part takes as long on a simulated clock as the link speed gives it
+# The simulated times each part started and ended are noted with its size
+class SimulatedBackend(DirectoryBackend):
+
+    def __init__(self, path, clock, speed):
+        super().__init__(path)
+        self.clock = clock
+        self.speed = speed
+        self.sent = []
+
+    def upload_part(self, name, upload_id, number, data):
+        start = self.clock.time()
+        self.clock.sleep(len(data) / self.speed)
+        self.sent.append((start, self.clock.time(), len(data)))
+        return super().upload_part(name, upload_id, number, data)
+
+
+# A multipart upload of one local file whose progress is saved so it can resume in a later run
+class MultipartUpload:
+
+    def __init__(self, backend, path, state_dir, part_size):
+        self.backend = backend
+        self.path = path
+        self.name = os.path.basename(path)
+        self.state_path = os.path.join(state_dir, f"{self.name}.json")
+        self.lock = threading.Lock()
+
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+
+        # Grow the part size if needed to stay under the S3 part limit
+        self.part_size = max(part_size, MIN_PART_SIZE, math.ceil(self.size / MAX_PARTS))
+        self.part_count = max(1, math.ceil(self.size / self.part_size))
+        self.upload_id = None
+        self.parts = {}
+        self.cpu = 0
+        self.sha256 = None
+        self.etag = None
+
+    # Load saved progress if it is for this same file, otherwise start a new upload
+    def start(self):
+        if os.path.isfile(self.state_path):
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+            if state['size'] == self.size and state['mtime'] == self.mtime:
+                self.upload_id = state['upload_id']
+                self.part_size = state['part_size']
+                self.part_count = max(1, math.ceil(self.size / self.part_size))
+                self.parts = {int(number): etag for number, etag in state['parts'].items()}
+                logging.debug(f"{self}: resuming with {len(self.parts)} of {self.part_count} parts done")
+                return
+            logging.debug(f"{self}: discarding saved progress for a different file")
+            self.backend.abort(self.name, state['upload_id'])
+
+        self.upload_id = self.backend.create(self.name)
+        self.save()
+
+    def save(self):
+        state = {'upload_id': self.upload_id, 'size': self.size, 'mtime': self.mtime, 'part_size': self.part_size,
+                 'parts': self.parts}
+        with open(f"{self.state_path}.tmp", 'w') as f:
+            json.dump(state, f)
+        os.rename(f"{self.state_path}.tmp", self.state_path)
+
+    # The ETag of a part is the MD5 of what was received, so a part that arrived damaged is caught here
+    def upload_part(self, number, data):
+        start = time.thread_time()
+        digest = hashlib.md5(data).hexdigest()
+        etag = self.backend.upload_part(self.name, self.upload_id, number, data)
+        if etag != digest:
+            raise Exception(f"{self}: part {number} was received with ETag {etag} but was sent with MD5 {digest}")
+        with self.lock:
+            self.parts[number] = etag
+            self.save()
+            self.cpu += time.thread_time() - start
+        return len(data)
+
+    # Upload the remaining parts, stopping early at the deadline. Returns True once the object is complete.
+    # The file is read once in order while its parts upload, so it is hashed on the way. The optional verify
+    # function is called with the sha256 and size read before the object is completed, and raises if it should not be.
+    # The optional throttle function is called with the size of each part before it is sent, and returns False
+    # if it should not be sent, which stops the upload as the deadline does.
+    def run(self, jobs=4, deadline=None, verify=None, throttle=None):
+        self.start()
+        start = time.thread_time()
+        file_hash = hashlib.sha256()
+        size = 0
+
+        with open(self.path, 'rb') as f, ThreadPoolExecutor(max_workers=jobs) as pool:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            running = set()
+            for number in range(1, self.part_count + 1):
+                data = f.read(self.part_size)
+                file_hash.update(data)
+                size += len(data)
+
+                # Parts uploaded by an earlier run are only read to be hashed, and are checked while they are
+                if number in self.parts:
+                    if hashlib.md5(data).hexdigest() != self.parts[number]:
+                        raise Exception(f"{self}: part {number} has changed since it was uploaded")
+                    continue
+
+                # No more parts are read ahead than there are jobs to upload them
+                while len(running) >= jobs:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                if deadline is not None and time.time() >= deadline:
+                    break
+                if throttle is not None and not throttle(len(data)):
+                    break
+                running.add(pool.submit(self.upload_part, number, data))
+            for future in running:
+                future.result()
+        self.cpu += time.thread_time() - start
+
+        if len(self.parts) < self.part_count:
+            logging.debug(f"{self}: stopped with {len(self.parts)} of {self.part_count} parts done")
+            return False
+
+        # An upload of anything other than what was written is abandoned, so the next run starts it again
+        self.sha256 = file_hash.hexdigest()
+        if verify is not None:
+            try:
+                verify(self.sha256, size)
+            except Exception:
+                self.backend.abort(self.name, self.upload_id)
+                os.remove(self.state_path)
+                raise
+
+        self.etag = self.backend.complete(self.name, self.upload_id, sorted(self.parts.items()))
+        os.remove(self.state_path)
+        expected = get_multipart_etag(self.parts[x] for x in sorted(self.parts))
+        if self.etag != expected:
+            raise Exception(f"{self}: completed with ETag {self.etag} but its parts make {expected}")
+        logging.debug(f"{self}: completed with ETag {self.etag}")
+        return True
+
+    def __str__(self):
+        return f"MultipartUpload {self.name}"
+
+
+# Bytes of path still to upload, counting the parts of a saved upload of this same file as sent
+def get_remaining_size(path, state_dir):
+    stat = os.stat(path)
+    state_path = os.path.join(state_dir, f"{os.path.basename(path)}.json")
+    if not os.path.isfile(state_path):
+        return stat.st_size
+    with open(state_path, 'r') as f:
+        state = json.load(f)
+    if state['size'] != stat.st_size or state['mtime'] != stat.st_mtime_ns:
+        return stat.st_size
+    return max(0, stat.st_size - len(state['parts']) * state['part_size'])
+
+
+# The ETag S3 gives an object uploaded in parts, the MD5 of the MD5s of the parts followed by the number of parts
+def get_multipart_etag(digests):
+    digests = [bytes.fromhex(x) for x in digests]
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
@@ -0,0 +1,145 @@
+import fcntl
+import logging
+import os
+import stat
+import struct
+import threading
+
+
+# Orders in which the files of an archive can be read ahead of tar, by inode number or by physical disk location
+READ_ORDERS = ('inode', 'extent')
+
+# ioctl asking the filesystem where a file's extents are on disk, with the struct fiemap header and extent layouts
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct('=QQIIII')
+FIEMAP_EXTENT = struct.Struct('=QQQQQIIII')
+
+
+# Return the regular files under path as (path, size, inode) in the order tarfile adds them
+# The listings and stats come from the archiver's traversal, which tar then takes them from as well
+def get_tar_order(path, traversal):
+    files = []
+    pending = [path]
+    while pending:
+        entry_path = pending.pop()
+        try:
+            entry_stat = traversal.lstat(entry_path)
+            if stat.S_ISDIR(entry_stat.st_mode):
+                pending.extend(os.path.join(entry_path, x) for x in reversed(traversal.list(entry_path)))
+            elif stat.S_ISREG(entry_stat.st_mode):
+                files.append((entry_path, entry_stat.st_size, entry_stat.st_ino))
+        except OSError:
+            continue
+    return files
+
+
+# Return the physical byte offset of the start of the file open as fd, or None if the filesystem will not say
+def get_physical_offset(fd):
+    request = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size)
+    FIEMAP_HEADER.pack_into(request, 0, 0, 2**64 - 1, 0, 0, 1, 0)
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    if FIEMAP_HEADER.unpack_from(request)[3] == 0:
+        return 0
+    return FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size)[1]
+
+
+# Reads the files of an archive into the page cache in physical order, a window ahead of tar reading them by name
+# Random reads on a slow array then become mostly sequential, while the tar itself is unchanged
+class Prefetcher:
+
+    def __init__(self, order, window):
+        self.order = order
+        self.window = window
+        self.condition = threading.Condition()
+        self.paths = []
+        self.offsets = [0]
+        self.index = {}
+        self.inodes = {}
+        self.issued = 0
+        self.consumed = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='prefetch', daemon=True)
+        self.thread.start()
+
+    # Queue files, as (path, size, inode) in tar order, to be read ahead
+    def extend(self, files):
+        with self.condition:
+            for path, size, inode in files:
+                self.index[path] = len(self.paths)
+                self.inodes[path] = inode
+                self.paths.append(path)
+                self.offsets.append(self.offsets[-1] + size)
+            self.condition.notify()
+
+    # Note that tar has read path, so everything queued before it is done with
+    def consume(self, path):
+        with self.condition:
+            index = self.index.get(path)
+            if index is not None and index + 1 > self.consumed:
+                self.consumed = index + 1
+                self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    # Bytes read ahead that tar has not reached yet
+    def get_outstanding(self):
+        return self.offsets[self.issued] - self.offsets[min(self.issued, self.consumed)]
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or (max(self.issued, self.consumed) < len(self.paths) and
+                                                                self.get_outstanding() < self.window))
+                if self.closed:
+                    return
+
+                # Take the next window of files in tar order, skipping any tar has already passed
+                start = max(self.issued, self.consumed)
+                end = start + 1
+                while end < len(self.paths) and self.offsets[end + 1] - self.offsets[start] <= self.window:
+                    end += 1
+                batch = self.paths[start:end]
+                self.issued = end
+            self.read_ahead(batch)
+
+    # Ask the kernel to read the files in order of where they are on disk
+    def read_ahead(self, paths):
+        keys = []
+        for path in paths:
+            try:
+                keys.append((self.get_key(path), path))
+            except OSError:
+                continue
+        for _, path in sorted(keys):
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+            except OSError:
+                continue
+            try:
+                os.posix_fadvise(fd, 0, min(os.fstat(fd).st_size, self.window), os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        logging.debug(f"{self}: read ahead {len(keys)} files")
+
+    # Files are sorted by where their data starts on disk, falling back to inode number
+    def get_key(self, path):
+        inode = self.inodes[path]
+        if self.order == 'extent':
+            fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+            try:
+                offset = get_physical_offset(fd)
+            finally:
+                os.close(fd)
+            if offset is not None:
+                return offset, inode
+        return 0, inode
+
+    def __str__(self):
+        return f"Prefetcher {self.order}"
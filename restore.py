@@ -0,0 +1,394 @@
+import argparse
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+import io
+import logging
+import lzma
+import os
+import re
+import shutil
+import struct
+import subprocess
+import tarfile
+import tempfile
+import zlib
+
+from catalog import Catalog
+from compressor import ZSTD_WINDOW_LOG
+from encrypter import get_decrypt_command
+
+# Every xz stream starts with these bytes and its footer ends with the footer magic
+XZ_MAGIC = b'\xfd7zXZ\x00'
+XZ_FOOTER_MAGIC = b'YZ'
+
+# Members are extracted with the tar filter where Python has extraction filters, from 3.9.17 and 3.10.12 on
+EXTRACT_OPTIONS = {'filter': 'tar'} if hasattr(tarfile, 'data_filter') else {}
+
+# Volumes of a file split across archives are named for the file with a part number
+VOLUME_PATTERN = re.compile(r'(.*)\.part(\d{4})$')
+
+
+parser = argparse.ArgumentParser(description='Restore files from retrieved archives using the catalog.')
+parser.add_argument('catalog', type=os.path.abspath, help='catalog file listing the members of every archive')
+parser.add_argument('archives', type=os.path.abspath,
+                    help='directory holding the retrieved archives, encrypted, compressed or neither')
+parser.add_argument('paths', nargs='+', help='files or directories to restore')
+parser.add_argument('-o', '--output', default='.', type=os.path.abspath, help='directory to restore into')
+parser.add_argument('--passphrase', default=None, type=os.path.abspath,
+                    help='passphrase file for encrypted archives, passphrase.txt beside the catalog by default')
+parser.add_argument('-j', '--jobs', default=4, type=int, help='number of archives to restore from at once')
+parser.add_argument('-d', '--debug', action='store_true', help='enable debug logging')
+
+
+def main():
+    args = parser.parse_args()
+    if args.passphrase is None:
+        args.passphrase = os.path.join(os.path.dirname(args.catalog), 'passphrase.txt')
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    # Find the newest copy of every member wanted and the volumes of split files, grouped by the archive holding them
+    catalog = Catalog(args.catalog)
+    members = {}
+    volumes = {}
+    for path in args.paths:
+        path = os.path.abspath(path)
+        rows = catalog.find(path) + catalog.find_volumes(path)
+        if not rows:
+            logging.warning(f"{path} is not in the catalog")
+        found, splits = select_volumes(rows)
+        for split_path, parts in splits.items():
+            volumes[split_path] = [x[0] for x in parts]
+            found += parts
+        for member in found:
+            members.setdefault(member[1], []).append(member)
+    catalog.close()
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(restore_archive, args, archive, archive_members)
+                   for archive, archive_members in sorted(members.items())]
+        for future in futures:
+            print(future.result())
+
+    for path, parts in volumes.items():
+        join_volumes(args.output, path, parts)
+
+
+# Keep only the newest copy of each path from catalog rows of (path, archive, size, mtime, offset, reference)
+def get_newest(rows):
+    newest = {}
+    for row in rows:
+        if row[0] not in newest or (row[3], row[1]) > (newest[row[0]][3], newest[row[0]][1]):
+            newest[row[0]] = row
+    return list(newest.values())
+
+
+# Separate the newest copy of each member from the volumes of files split across archives, which are returned
+# as the volumes of the newest split of each file in order. A later pass can split a file into fewer volumes, or
+# find it fits in one archive, so volumes of older splits are left out. The volumes of one split all carry the
+# mtime of the file, and every one but the last is the same size.
+def select_volumes(rows):
+    members = []
+    splits = {}
+    for row in rows:
+        match = VOLUME_PATTERN.match(row[0])
+        if match is None or row[5] is not None:
+            members.append(row)
+        else:
+            splits.setdefault(match.group(1), {}).setdefault(row[3], []).append(row)
+    members = {x[0]: x for x in get_newest(members)}
+
+    volumes = {}
+    for path, by_mtime in splits.items():
+        mtime = max(by_mtime)
+        if path in members and members[path][3] >= mtime:
+            continue
+        members.pop(path, None)
+        newest = sorted(get_newest(by_mtime[mtime]))
+        parts = []
+        for part in newest:
+            if int(VOLUME_PATTERN.match(part[0]).group(2)) != len(parts) + 1:
+                break
+            parts.append(part)
+            if part[2] < parts[0][2]:
+                break
+        if len(parts) < len(newest):
+            logging.warning(f"{path} has volumes missing or left over from its newest split, joining {len(parts)}")
+        volumes[path] = parts
+    return list(members.values()), volumes
+
+
+# Return the path of the retrieved copy of an archive, whichever stage of the pipeline it is from
+def find_archive(args, archive):
+    for suffix in ('.xz.gpg', '.zst.gpg', '.gpg', '.xz', '.zst', ''):
+        path = os.path.join(args.archives, f"{archive}{suffix}")
+        if os.path.isfile(path):
+            return path
+    raise FileNotFoundError(f"archive {archive} has not been retrieved into {args.archives}")
+
+
+# Extract members from one archive, decompressing only the blocks that hold them
+def restore_archive(args, archive, members):
+    path = find_archive(args, archive)
+    decrypted = None
+    try:
+        if path.endswith('.gpg'):
+            handle, decrypted = tempfile.mkstemp(suffix=os.path.splitext(path[:-len('.gpg')])[1], dir=args.output)
+            os.close(handle)
+            subprocess.run(get_decrypt_command(args.passphrase, decrypted, path), check=True)
+            path = decrypted
+        reader = get_reader(path)
+
+        # Opening the tar reads the member at the first offset, and every other member is read by seeking forward
+        # Files left out as copies of a member are at its offset too, so each offset is read once for all of them
+        rows = {}
+        for member in members:
+            rows.setdefault(member[4], []).append(member)
+        offsets = sorted(rows)
+        reader.seek(offsets[0])
+        with reader, tarfile.open(fileobj=reader, mode='r:') as tar:
+            extract_member(args, tar, tar.next(), rows[offsets[0]])
+            for offset in offsets[1:]:
+                reader.seek(offset)
+                tar.offset = offset
+                extract_member(args, tar, tarfile.TarInfo.fromtarfile(tar), rows[offset])
+
+        if isinstance(reader, XzBlockReader):
+            return f"restored {len(members)} members from {archive} using {len(reader.used)} of " \
+                   f"{len(reader.blocks)} blocks"
+        return f"restored {len(members)} members from {archive}"
+    finally:
+        if decrypted is not None and os.path.isfile(decrypted):
+            os.remove(decrypted)
+
+
+# Extract a member as every catalog row at its offset, the member itself or files that were copies of it
+# The member is extracted once, under the path of the first row, and copied from there to the paths of the others
+def extract_member(args, tar, tarinfo, rows):
+    path, _, _, mtime, _, reference = rows[0]
+    if reference is not None:
+        tarinfo.name = path.lstrip('/')
+        tarinfo.mtime = mtime
+    tar.extract(tarinfo, args.output, **EXTRACT_OPTIONS)
+    extracted = os.path.join(args.output, tarinfo.name)
+    for path, _, _, mtime, _, _ in rows[1:]:
+        target = os.path.join(args.output, path.lstrip('/'))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(extracted, target)
+        os.utime(target, (mtime, mtime))
+
+
+# Open the uncompressed tar data of an archive, decoded as its suffix says it was compressed
+def get_reader(path):
+    if path.endswith('.xz'):
+        return XzBlockReader(path)
+    if path.endswith('.zst'):
+        return PipeReader(['zstd', '-d', '-c', '-q', f'--long={ZSTD_WINDOW_LOG}', path])
+    return open(path, 'rb')
+
+
+# Join the restored volumes of a file split across archives back into the file
+def join_volumes(output, path, parts):
+    target = os.path.join(output, path.lstrip('/'))
+    with open(target, 'wb') as f:
+        for part in parts:
+            part_path = os.path.join(output, part.lstrip('/'))
+            with open(part_path, 'rb') as part_file:
+                while True:
+                    chunk = part_file.read(2**20)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            os.remove(part_path)
+    print(f"joined {len(parts)} volumes into {target}")
+
+
+# Return a variable length integer from data at position, and the position after it
+def read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+
+def write_varint(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+# Blocks take their unpadded size rounded up to a multiple of four bytes
+def get_padded_size(size):
+    return -(-size // 4) * 4
+
+
+# Return the blocks of an xz file from its indexes as (uncompressed offset, uncompressed size, stream header,
+# file offset, unpadded size) along with the total uncompressed size
+def read_xz_blocks(f):
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    streams = []
+    while end > 0:
+
+        # Streams can be followed by padding of zero bytes
+        f.seek(end - 4)
+        while end > 0 and f.read(4) == b'\x00' * 4:
+            end -= 4
+            f.seek(end - 4)
+
+        f.seek(end - 12)
+        footer = f.read(12)
+        if footer[10:] != XZ_FOOTER_MAGIC:
+            raise ValueError(f"{f.name} does not end with an xz stream footer")
+        index_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+        index_start = end - 12 - index_size
+        f.seek(index_start)
+        index = f.read(index_size)
+
+        count, position = read_varint(index, 1)
+        records = []
+        for _ in range(count):
+            unpadded, position = read_varint(index, position)
+            size, position = read_varint(index, position)
+            records.append((unpadded, size))
+
+        stream_start = index_start - sum(get_padded_size(x[0]) for x in records) - 12
+        f.seek(stream_start)
+        header = f.read(12)
+        if header[:6] != XZ_MAGIC:
+            raise ValueError(f"{f.name} has an xz index that does not match its blocks")
+        streams.insert(0, (stream_start, header, records))
+        end = stream_start
+
+    blocks = []
+    uncompressed = 0
+    for stream_start, header, records in streams:
+        offset = stream_start + 12
+        for unpadded, size in records:
+            blocks.append((uncompressed, size, header, offset, unpadded))
+            offset += get_padded_size(unpadded)
+            uncompressed += size
+    return blocks, uncompressed
+
+
+# Seekable reader of the uncompressed data of an xz file that only decompresses the blocks read from
+# Each block is decompressed on its own by wrapping it in a stream of one block
+class XzBlockReader:
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.blocks, self.size = read_xz_blocks(self.file)
+        self.starts = [x[0] for x in self.blocks]
+        self.position = 0
+        self.cached = None
+        self.data = b''
+        self.used = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size - self.position
+        chunks = []
+        while size > 0 and self.position < self.size:
+            number = bisect.bisect_right(self.starts, self.position) - 1
+            data = self.get_block(number)
+            start = self.position - self.starts[number]
+            chunk = data[start:start + size]
+            chunks.append(chunk)
+            self.position += len(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def get_block(self, number):
+        if self.cached == number:
+            return self.data
+        _, size, header, offset, unpadded = self.blocks[number]
+        self.file.seek(offset)
+        block = self.file.read(get_padded_size(unpadded))
+
+        index = b'\x00' + write_varint(1) + write_varint(unpadded) + write_varint(size)
+        index += b'\x00' * (-len(index) % 4)
+        index += struct.pack('<I', zlib.crc32(index))
+        footer = struct.pack('<I', len(index) // 4 - 1) + header[6:8]
+        footer = struct.pack('<I', zlib.crc32(footer)) + footer + XZ_FOOTER_MAGIC
+
+        self.data = lzma.decompress(header + block + index + footer, format=lzma.FORMAT_XZ)
+        self.cached = number
+        self.used.add(number)
+        logging.debug(f"{self}: decompressed block {number} of {len(self.blocks)}")
+        return self.data
+
+    def close(self):
+        self.file.close()
+
+    def __str__(self):
+        return f"XzBlockReader {os.path.basename(self.path)}"
+
+
+# Reader of a command's output that can seek forward, which is all a restore of members in offset order needs
+class PipeReader:
+
+    def __init__(self, command):
+        self.child = subprocess.Popen(command, stdout=subprocess.PIPE)
+        self.position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        if whence == os.SEEK_END or offset < self.position:
+            raise io.UnsupportedOperation(f"{self} can only seek forward")
+        while self.position < offset:
+            if not self.read(min(offset - self.position, 2**20)):
+                break
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        data = self.child.stdout.read(size)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.child.stdout.close()
+        self.child.kill()
+        self.child.wait()
+
+    def __str__(self):
+        return f"PipeReader {self.child.args[0]}"
+
+
+if __name__ == '__main__':
+    main()
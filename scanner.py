@@ -0,0 +1,182 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import stat
+import tarfile
+import threading
+
+
+# Number of entries counted in a directory before the running total is updated
+FLUSH_ENTRIES = 1024
+
+
+# Measure the size path takes in a tar archive, stopping once the total passes max_size
+# Returns the size and whether it is complete, as an incomplete size is only a lower bound
+def scan_size(path, max_size, threads=16):
+    return DirectoryScanner(max_size, threads).run(path)
+
+
+# Bytes an entry takes in a GNU tar archive: its header, the extra header and name blocks of a name over 100 bytes,
+# and data_size bytes of data padded to whole blocks. Only regular files have data, and only the first of their
+# hard links, which the rest are written as links to.
+def get_tar_size(path, data_size=0, is_dir=False):
+    size = tarfile.BLOCKSIZE + -(-data_size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+    # Directory names are written with a trailing slash
+    name_size = len(os.fsencode(path.lstrip('/'))) + (1 if is_dir else 0)
+    if name_size > tarfile.LENGTH_NAME:
+        size += tarfile.BLOCKSIZE + -(-(name_size + 1) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    return size
+
+
+class DirectoryScanner:
+
+    def __init__(self, max_size, threads):
+        self.max_size = max_size
+        self.threads = threads
+        self.condition = threading.Condition()
+        self.pool = None
+        self.size = 0
+        self.pending = 0
+        self.stopped = False
+        self.hard_links = set()
+        self.syscalls = 0
+        self.cancelled = False
+
+    def run(self, path):
+        self.size = get_tar_size(path, is_dir=True)
+        self.syscalls = 0
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        with self.condition:
+            self.submit(path)
+
+            # Wait until every directory has been read, the budget is exceeded or the scan is cancelled
+            while self.pending > 0 and self.size <= self.max_size and not self.cancelled:
+                self.condition.wait()
+            complete = self.pending == 0 and not self.cancelled
+            self.stopped = True
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+        logging.debug(f"scanned {path} to {'' if complete else 'at least '}{self.size} bytes")
+        return self.size, complete
+
+    # Stop a scan running in another thread, which then returns what it has as incomplete
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.stopped = True
+            self.condition.notify_all()
+
+    # Queue a directory to be read, the condition lock must be held
+    def submit(self, path):
+        if self.stopped:
+            return
+        self.pending += 1
+        self.pool.submit(self.scan, path)
+
+    # Each directory is one listing and each entry one stat, counted in syscalls
+    def scan(self, path):
+        count = 0
+        try:
+            size = 0
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    entry_stat = entry.stat(follow_symlinks=False)
+                    is_dir = stat.S_ISDIR(entry_stat.st_mode)
+                    count += 1
+
+                    # Like tar, count the data of hard linked files only once
+                    data_size = entry_stat.st_size if stat.S_ISREG(entry_stat.st_mode) else 0
+                    if entry_stat.st_nlink > 1 and data_size:
+                        key = (entry_stat.st_dev, entry_stat.st_ino)
+                        with self.condition:
+                            if key in self.hard_links:
+                                data_size = 0
+                            self.hard_links.add(key)
+                    size += get_tar_size(entry.path, data_size, is_dir)
+
+                    if is_dir:
+                        with self.condition:
+                            self.submit(entry.path)
+
+                    # Periodically publish progress so a huge directory can end the scan early
+                    if count % FLUSH_ENTRIES == 0:
+                        with self.condition:
+                            self.size += size
+                            self.condition.notify()
+                            if self.stopped:
+                                return
+                        size = 0
+
+            with self.condition:
+                self.size += size
+
+        # Skip anything we cannot read, as du would
+        except OSError as e:
+            logging.warning(f"unable to scan {path}: {e}")
+        finally:
+            with self.condition:
+                self.syscalls += count + 1
+                self.pending -= 1
+                self.condition.notify()
+
+
+# Measures the directories coming up after the item being archived in background threads, so scanning the array's
+# metadata overlaps with tar reading its data. No more than depth directories are measured or held at once.
+# Each measured size is handed to record along with the stat of the directory taken before it was measured.
+class SizeLookahead:
+
+    def __init__(self, depth, max_size, threads, record):
+        self.depth = depth
+        self.max_size = max_size
+        self.threads = threads
+        self.record = record
+        self.pool = ThreadPoolExecutor(max_workers=depth) if depth > 0 else None
+        self.scans = {}
+        self.seen = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # True if no more directories can be measured until one already measured is taken
+    def is_full(self):
+        return self.pool is None or len(self.scans) >= self.depth
+
+    # Start measuring path unless as many as depth are outstanding
+    def submit(self, path, path_stat):
+        if self.is_full() or path in self.scans:
+            return
+        scanner = DirectoryScanner(self.max_size, self.threads)
+        self.scans[path] = (path_stat, scanner, self.pool.submit(scanner.run, path))
+
+    # Record the size of path and return it, waiting for it if it is still being measured
+    # Returns None if path is not being measured
+    def take(self, path):
+        if path not in self.scans:
+            return None
+        path_stat, scanner, future = self.scans.pop(path)
+        size, complete = future.result()
+        self.record(path, path_stat, size, complete, scanner.syscalls)
+        logging.debug(f"{self}: measured {path} ahead as {size}")
+        return size
+
+    # Cancel the measurements still running and record those that have finished, which the next archive can use
+    def close(self):
+        if self.pool is None:
+            return
+        for path, (path_stat, scanner, future) in self.scans.items():
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.record(path, path_stat, *future.result(), scanner.syscalls)
+            else:
+                future.cancel()
+                scanner.cancel()
+        logging.debug(f"{self}: closed with {len(self.scans)} directories measured or measuring")
+        self.scans = {}
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.pool = None
+
+    def __str__(self):
+        return f"SizeLookahead {self.depth}"
@@ -0,0 +1,154 @@
+import logging
+import os
+import threading
+import time
+
+from common import convert_tgmk
+from multipart import get_remaining_size
+
+# Seconds of sending at the full rate that can build up while nothing is being sent
+BURST_SECONDS = 1
+
+
+# Convert hour ranges such as 0-6,20-23, each with an optional rate in bytes per second such as 0-6=200M,20-23,
+# into the rate of each hour in which uploads may run, where a rate of None is unlimited
+def parse_windows(value):
+    windows = {}
+    for window in value.split(','):
+        hours, _, rate = window.partition('=')
+        start, _, end = hours.partition('-')
+        for hour in range(int(start), int(end or start) + 1):
+            windows[hour] = convert_tgmk(rate) if rate else None
+    return windows
+
+
+# Return the start of the local hour holding now, which in a timezone offset by part of an hour is not on a
+# multiple of an hour since the epoch
+def get_hour_start(now):
+    local = time.localtime(now)
+    return now - now % 1 - local.tm_min * 60 - local.tm_sec
+
+
+# The real clock, which a simulated one stands in for to test a schedule without waiting for it
+class Clock:
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+# A clock that only moves when slept on, so a day of windows can be run through in moments
+class SimulatedClock(Clock):
+
+    def __init__(self, start):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+# Decides when uploads may run, how fast, and which waiting file to upload next
+# Sending is limited by a token bucket filled at the rate of the current hour. Parts are paid for before they are
+# sent, so a part that could not start before the window ends is left for the next window.
+class UploadScheduler:
+
+    def __init__(self, windows, speed=None, clock=None):
+        self.windows = windows
+        self.speed = speed
+        self.clock = Clock() if clock is None else clock
+        self.lock = threading.Lock()
+        self.tokens = 0
+        self.updated = self.clock.time()
+
+    def is_open(self, now=None):
+        now = self.clock.time() if now is None else now
+        return time.localtime(now).tm_hour in self.windows
+
+    # The rate limit at time now, None if unlimited
+    def get_rate(self, now):
+        return self.windows.get(time.localtime(now).tm_hour)
+
+    # Return the time the run of open hours holding now ends, or None if every hour is open
+    def get_window_end(self, now=None):
+        now = self.clock.time() if now is None else now
+        if len(self.windows) == 24:
+            return None
+        end = get_hour_start(now)
+        while self.is_open(end):
+            end += 3600
+        return end
+
+    # Sleep until an upload window opens
+    def wait_for_window(self):
+        while not self.is_open():
+            now = self.clock.time()
+            self.clock.sleep(get_hour_start(now) + 3600 - now)
+
+    # Bytes that can be sent from now until end, at each hour's rate or the measured speed if that is slower
+    # Infinite if neither limits an hour
+    def get_capacity(self, now, end):
+        if end is None:
+            return float('inf')
+        capacity = 0
+        while now < end:
+            rates = [x for x in (self.get_rate(now), self.speed) if x is not None]
+            if not rates:
+                return float('inf')
+            hour_end = min(end, get_hour_start(now) + 3600)
+            capacity += (hour_end - now) * min(rates)
+            now = hour_end
+        return capacity
+
+    # Pick the next of paths to upload, given the bytes still to send of uploads already running
+    # Of the files that can finish in this window, uploads already started come first and then files in the order
+    # given. If none can, the one nearest done is started, and resumes in the next window.
+    def choose(self, paths, state_dir, committed=0):
+        now = self.clock.time()
+        capacity = self.get_capacity(now, self.get_window_end(now)) - committed
+        remaining = {x: get_remaining_size(x, state_dir) for x in paths}
+        fitting = [x for x in paths if remaining[x] <= capacity]
+        if fitting:
+            started = [x for x in fitting if remaining[x] < os.path.getsize(x)]
+            path = (started or fitting)[0]
+        else:
+            path = min(paths, key=lambda x: remaining[x])
+            logging.debug(f"{self}: nothing can finish in this window, starting {path}")
+        return path
+
+    # Wait until size more bytes may be sent, or return False if they cannot be sent before the window ends,
+    # judged by the measured speed where it is known. Bytes that cannot be sent wait out the window instead, so
+    # nothing else is started in the time left.
+    def throttle(self, size):
+        with self.lock:
+            now = self.clock.time()
+            if not self.is_open(now):
+                return False
+
+            # Fill the bucket for the time since it was last used, then take the part from it even if that leaves
+            # it owing, which the part waits out before it is sent
+            rate = self.get_rate(now)
+            wait = 0
+            if rate is not None:
+                self.tokens = min(rate * BURST_SECONDS, self.tokens + (now - self.updated) * rate)
+                self.updated = now
+                wait = max(0, (size - self.tokens) / rate)
+            end = self.get_window_end(now)
+            fits = end is None or now + wait + (size / self.speed if self.speed else 0) <= end
+            if fits and rate is not None:
+                self.tokens -= size
+
+        if not fits:
+            logging.debug(f"{self}: pausing until the window ends as {size} bytes cannot be sent before it does")
+            self.clock.sleep(end - now)
+            return False
+        if wait > 0:
+            self.clock.sleep(wait)
+        return True
+
+    def __str__(self):
+        return f"UploadScheduler {len(self.windows)} hours"
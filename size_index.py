@@ -0,0 +1,72 @@
+import logging
+import os
+import sqlite3
+
+
+# Persistent record of directory sizes in a tar so restarts do not repeat slow size calculations
+class SizeIndex:
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+
+        # Sizes were apparent sizes before they were tar sizes, so drop any measured that way
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] < 1:
+            self.connection.execute("DROP TABLE IF EXISTS sizes")
+            self.connection.execute("PRAGMA user_version = 1")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS sizes (path TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                                "complete INTEGER NOT NULL, mtime INTEGER NOT NULL, inode INTEGER NOT NULL)")
+        self.connection.commit()
+
+    # Return the recorded size of path, or None if it is unknown, stale, or too small to be useful
+    # A stat of path already taken can be passed in to check against rather than taking another
+    def get(self, path, max_size, stat=None):
+        row = self.connection.execute("SELECT size, complete, mtime, inode FROM sizes WHERE path = ?",
+                                      (path,)).fetchone()
+        if row is None:
+            return None
+        size, complete, mtime, inode = row
+
+        # A directory whose entries have changed since it was measured must be measured again
+        if stat is None:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+        if stat is None or stat.st_mtime_ns != mtime or stat.st_ino != inode:
+            logging.debug(f"{self}: discarding stale size of {path}")
+            self.connection.execute("DELETE FROM sizes WHERE path = ?", (path,))
+            self.connection.commit()
+            return None
+
+        # A partial result is a lower bound, so it only answers the question if it is already too big
+        if not complete and size <= max_size:
+            return None
+        return size
+
+    # Record the size of path as measured after the stat was taken
+    def put(self, path, stat, size, complete=True):
+        self.connection.execute("INSERT OR REPLACE INTO sizes (path, size, complete, mtime, inode) "
+                                "VALUES (?, ?, ?, ?, ?)", (path, size, int(complete), stat.st_mtime_ns, stat.st_ino))
+        self.connection.commit()
+
+    # Forget every path that has already been archived, which is everything up to the checkpoint
+    # Paths are compared a name at a time, the order directories are listed and archived in, so a/b comes before a.b
+    def evict(self, checkpoint):
+        names = checkpoint.split("/")
+        archived = []
+        for (path,) in self.connection.execute("SELECT path FROM sizes"):
+            path_names = path.split("/")
+            if path_names[:len(names)] == names:
+                archived.append((path,))
+            elif path_names < names and names[:len(path_names)] != path_names:
+                archived.append((path,))
+        self.connection.executemany("DELETE FROM sizes WHERE path = ?", archived)
+        self.connection.commit()
+        logging.debug(f"{self}: evicted {len(archived)} entries up to {checkpoint}")
+
+    def close(self):
+        self.connection.close()
+
+    def __str__(self):
+        return f"SizeIndex {self.path}"
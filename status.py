@@ -0,0 +1,49 @@
+import argparse
+from datetime import datetime, timedelta
+import json
+import os
+
+from metrics import get_status
+
+
+parser = argparse.ArgumentParser(description='Summarize the backlog, recent throughput and ETA of each stage.')
+parser.add_argument('working_dir', type=os.path.abspath, help='archiver working directory')
+parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+
+
+def main():
+    args = parser.parse_args()
+    assert os.path.isdir(args.working_dir)
+    status = get_status(args.working_dir)
+    if args.json:
+        print(json.dumps(status, indent=2))
+        return
+
+    print(f"{'stage':<10}{'queued':>8}{'bytes':>12}{'MB/s':>10}{'eta':>16}  last")
+    for name, stage in status['stages'].items():
+        rate = stage['bytes_per_second']
+        print(f"{name:<10}{stage.get('queue_files', ''):>8}{format_bytes(stage.get('queue_bytes')):>12}"
+              f"{'' if rate is None else f'{rate / 2**20:.1f}':>10}{format_seconds(stage.get('eta')):>16}  "
+              f"{'' if stage['last'] is None else datetime.fromtimestamp(stage['last']).strftime('%Y%m%dT%H%M%S')}")
+    print(f"checkpoint {status['checkpoint']}")
+    for name, checkpoint in status['partitions'].items():
+        print(f"checkpoint {checkpoint} for partition {name}")
+
+
+def format_bytes(size):
+    if size is None:
+        return ''
+    for unit in ('', 'K', 'M', 'G', 'T'):
+        if abs(size) < 1024 or unit == 'T':
+            return f"{size:.1f}{unit}" if unit else f"{size}"
+        size /= 1024
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return ''
+    return str(timedelta(seconds=round(seconds)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+import argparse
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+import archiver
+from common import convert_tgmk, get_smtp_handler
+import compressor
+import encrypter
+from metrics import get_status, STAGE_QUEUES
+from multipart import get_backend
+from scheduler import parse_windows, UploadScheduler
+import uploader
+
+
+parser = argparse.ArgumentParser(description='Run every stage of the archiver pipeline in one long-running process.')
+parser.add_argument('source', type=os.path.abspath, help='path to be archived')
+parser.add_argument('working_dir', type=os.path.abspath, help='archiver working directory')
+parser.add_argument('-m', '--max-size', default='512G', type=convert_tgmk,
+                    help='maximum size of an archive file (K, M, G, P supported)')
+parser.add_argument('-s', '--stop', default='100T', type=convert_tgmk,
+                    help='maximum size of an destination directory (K, M, G, P supported)')
+parser.add_argument('-t', '--threads', default=1, type=int, help='threads to use for compression, shared by all jobs')
+parser.add_argument('--partitions', default=None,
+                    help='archive disjoint subtrees of the source at once, each with its own worker: mounts, top, '
+                         'or a comma separated list of paths')
+parser.add_argument('--codec', default='auto', choices=['auto'] + list(compressor.CODEC_SUFFIXES),
+                    help='codec to compress with, or auto to choose for each file from samples of it')
+parser.add_argument('--compress-jobs', default=1, type=int, help='number of files to compress at once')
+parser.add_argument('--encrypt-jobs', default=1, type=int, help='number of files to encrypt at once')
+parser.add_argument('--upload-jobs', default=1, type=int, help='number of files to upload at once')
+parser.add_argument('--part-jobs', default=4, type=int, help='number of parts of each file to upload at once')
+parser.add_argument('--part-size', default='64M', type=convert_tgmk,
+                    help='size of each part of a multipart upload (K, M, G, P supported)')
+parser.add_argument('--bucket', default=uploader.BUCKET, help='upload destination, an S3 url or a local directory')
+parser.add_argument('--upload-hours', default='0-6,20-23',
+                    help='hours of the day in which uploads may run, each with an optional limit in bytes per second '
+                         '(K, M, G, P supported), such as 0-6=200M,20-23')
+parser.add_argument('--rescan', default=600, type=int,
+                    help='seconds between scans of the working directory for work not handed off directly')
+parser.add_argument('-d', '--debug', action='store_true', help='enable debug logging')
+
+
+def main():
+
+    # Verify and check inputs
+    args = parser.parse_args()
+    args.upload_hours = parse_windows(args.upload_hours)
+    assert os.path.isdir(args.working_dir)
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.getLogger().addHandler(get_smtp_handler())
+
+    logging.debug(f"supervisor starting")
+    stages = get_stages(args)
+    for stage in stages.values():
+        stage.start()
+
+    # Rebuild the queues from whatever the last process left in the working directory
+    scan(args, stages)
+
+    archive_args = archiver.parser.parse_args([args.source, args.working_dir])
+    archive_args.max_size = args.max_size
+    archive_args.stop = args.stop
+    archive_args.debug = args.debug
+    archive_args.partitions = args.partitions
+    archive_args.handoff = stages['compress'].put
+    threading.Thread(target=run_archiver, args=(archive_args, args.rescan), name='archive', daemon=True).start()
+
+    # Pick up anything that was not handed off, such as work left by a previous process
+    while True:
+        time.sleep(args.rescan)
+        scan(args, stages)
+
+
+# Create the stages, each handing its products straight to the next
+def get_stages(args):
+    compress_args = compressor.parser.parse_args([args.working_dir, '--codec', args.codec])
+    compress_args.threads = max(1, args.threads // args.compress_jobs)
+    encrypt_args = encrypter.parser.parse_args([args.working_dir])
+    upload_args = uploader.parser.parse_args([args.working_dir, '--bucket', args.bucket])
+    upload_args.part_jobs = args.part_jobs
+    upload_args.part_size = args.part_size
+
+    for stage_args in (compress_args, encrypt_args):
+        path = os.path.join(args.working_dir, stage_args.destination)
+        if not os.path.exists(path):
+            os.makedirs(path)
+    state_dir = os.path.join(args.working_dir, "uploads")
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    backend = get_backend(args.bucket)
+
+    def compress(path):
+        product, size, timer = compressor.timed_compress(compress_args, path, compress_args.threads)
+        compressor.report_compressed(args.working_dir, product, size, timer)
+        return product
+
+    def encrypt(path):
+        product, size, timer = encrypter.timed_encrypt(encrypt_args, path)
+        encrypter.report_encrypted(args.working_dir, product, size, timer)
+        return product
+
+    # Uploads run in the upload hours at each hour's rate and stop taking new parts when they end
+    speed = get_status(args.working_dir)['stages']['upload']['bytes_per_second']
+    scheduler = UploadScheduler(args.upload_hours, speed)
+
+    def upload(path):
+        uploader.upload(upload_args, backend, path, state_dir, scheduler)
+
+    upload_stage = ScheduledStage('upload', upload, args.upload_jobs, scheduler, state_dir)
+    encrypt_stage = Stage('encrypt', encrypt, args.encrypt_jobs, upload_stage)
+    compress_stage = Stage('compress', compress, args.compress_jobs, encrypt_stage)
+    return {'compress': compress_stage, 'encrypt': encrypt_stage, 'upload': upload_stage}
+
+
+# Queue every file waiting in a stage's source folder
+def scan(args, stages):
+    for name, (folder, suffixes) in STAGE_QUEUES.items():
+        path = os.path.join(args.working_dir, folder)
+        if not os.path.isdir(path):
+            continue
+        for listing in sorted(os.listdir(path)):
+            if listing.endswith(suffixes):
+                stages[name].put(os.path.join(path, listing))
+
+
+# Keep archiving, waiting out any time the working directory is full, until everything has been archived
+def run_archiver(args, delay):
+    while True:
+        try:
+            run = archiver.run_partitions if args.partitions else archiver.run
+            if run(args):
+                logging.debug(f"supervisor archiver has archived everything")
+                return
+        except Exception as e:
+            logging.exception('Unhandled Exception in archiver', exc_info=e)
+        time.sleep(delay)
+
+
+# A pipeline stage with its own work queue and a fixed number of worker threads
+class Stage:
+
+    def __init__(self, name, work, jobs, next_stage=None):
+        self.name = name
+        self.work = work
+        self.jobs = jobs
+        self.next_stage = next_stage
+        self.queue = queue.Queue()
+        self.queued = set()
+        self.lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.jobs):
+            threading.Thread(target=self.worker, name=f"{self.name}-{i}", daemon=True).start()
+
+    # Queue a path unless it is already waiting or being worked on
+    def put(self, path):
+        with self.lock:
+            if path in self.queued:
+                return
+            self.queued.add(path)
+        self.queue.put(path)
+
+    def get(self):
+        return self.queue.get()
+
+    def worker(self):
+        while True:
+            path = self.get()
+            product = None
+            try:
+                # A scan can queue a file just before the previous worker on it removes it
+                if not os.path.exists(path):
+                    continue
+                product = self.work(path)
+
+            # A failed file stays where it is and is retried on the next scan
+            except Exception as e:
+                logging.exception(f'Unhandled Exception in {self.name} of {path}', exc_info=e)
+            finally:
+                with self.lock:
+                    self.queued.discard(path)
+
+            if product is not None and self.next_stage is not None:
+                self.next_stage.put(product)
+
+    def __str__(self):
+        return f"Stage {self.name}"
+
+
+# A stage whose workers wait for the upload window and then let the scheduler choose among the files waiting,
+# rather than taking them in the order they came
+class ScheduledStage(Stage):
+
+    def __init__(self, name, work, jobs, scheduler, state_dir, next_stage=None):
+        super().__init__(name, work, jobs, next_stage)
+        self.scheduler = scheduler
+        self.state_dir = state_dir
+        self.waiting = []
+        self.condition = threading.Condition(self.lock)
+
+    def put(self, path):
+        with self.lock:
+            if path in self.queued:
+                return
+            self.queued.add(path)
+            self.waiting.append(path)
+            self.condition.notify()
+
+    def get(self):
+        while True:
+            self.scheduler.wait_for_window()
+            with self.lock:
+                # A scan can queue a file just before the previous worker on it removes it
+                for path in [x for x in self.waiting if not os.path.exists(x)]:
+                    self.waiting.remove(path)
+                    self.queued.discard(path)
+                if not self.waiting:
+                    self.condition.wait()
+                    continue
+                path = self.scheduler.choose(self.waiting, self.state_dir)
+                self.waiting.remove(path)
+                return path
+
+
+if __name__ == '__main__':
+    main()
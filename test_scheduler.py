@@ -0,0 +1,94 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from multipart import MIN_PART_SIZE, SimulatedBackend
+from scheduler import BURST_SECONDS, get_hour_start, parse_windows, SimulatedClock, UploadScheduler
+from uploader import upload_all
+
+# A timezone half an hour off UTC, where local hours do not start on whole hours since the epoch
+TIMEZONE = 'IST-5:30'
+
+
+# Upload files through the scheduler on a simulated clock, against a local bucket that takes as long as the link
+# speed gives each part, in a timezone where hours start half way through UTC ones
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.timezone = os.environ.get('TZ')
+        os.environ['TZ'] = TIMEZONE
+        time.tzset()
+        self.working_dir = tempfile.mkdtemp(prefix='archiver-test-')
+        for name in ('gpg', 'uploads', 'bucket'):
+            os.makedirs(os.path.join(self.working_dir, name))
+        self.source = os.path.join(self.working_dir, 'gpg')
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+        if self.timezone is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self.timezone
+        time.tzset()
+
+    # Write files of the given sizes to be uploaded
+    def make_files(self, sizes):
+        for i, size in enumerate(sizes):
+            with open(os.path.join(self.source, f"file{i:02d}.tar.xz.gpg"), 'wb') as f:
+                f.write(os.urandom(size))
+
+    # Run the uploader as the supervisor does from hour on the first of January until everything is uploaded
+    def upload(self, hours, speed, hour=0):
+        start = time.mktime((2026, 1, 1, hour, 0, 0, 0, 0, -1))
+        clock = SimulatedClock(start)
+        scheduler = UploadScheduler(parse_windows(hours), speed, clock)
+        backend = SimulatedBackend(os.path.join(self.working_dir, 'bucket'), clock, speed)
+        args = argparse.Namespace(working_dir=self.working_dir, jobs=1, part_jobs=1, part_size=MIN_PART_SIZE)
+        while os.listdir(self.source):
+            self.assertLess(clock.time(), start + 7 * 24 * 3600, "uploads did not finish in a week")
+            scheduler.wait_for_window()
+            upload_all(args, backend, self.source, os.path.join(self.working_dir, 'uploads'), scheduler)
+        return scheduler, backend
+
+    def test_nothing_sent_outside_windows(self):
+        self.make_files([3 * MIN_PART_SIZE, 2 * MIN_PART_SIZE])
+        scheduler, backend = self.upload('1=4K,3=4K', 8000)
+        for start, end, _ in backend.sent:
+            self.assertTrue(scheduler.is_open(start))
+            self.assertLessEqual(end, scheduler.get_window_end(start))
+
+    def test_rate_limit_holds_in_each_window(self):
+        self.make_files([4 * MIN_PART_SIZE])
+        scheduler, backend = self.upload('1-2=3K,4=6K', 100000)
+        hours = {}
+        for start, _, size in backend.sent:
+            hours[get_hour_start(start)] = hours.get(get_hour_start(start), 0) + size
+        for hour, size in hours.items():
+            rate = scheduler.get_rate(hour)
+            self.assertLessEqual(size, rate * (3600 + BURST_SECONDS))
+
+    def test_upload_paused_at_window_end_resumes_in_next_window(self):
+        self.make_files([4 * MIN_PART_SIZE])
+        scheduler, backend = self.upload('2=4K,5=4K', 8000)
+        windows = {scheduler.get_window_end(x[0]) for x in backend.sent}
+        self.assertGreater(len(windows), 1)
+        self.assertEqual(sum(x[2] for x in backend.sent), 4 * MIN_PART_SIZE)
+        with open(os.path.join(self.working_dir, 'bucket', 'file00.tar.xz.gpg'), 'rb') as f:
+            self.assertEqual(len(f.read()), 4 * MIN_PART_SIZE)
+
+    def test_windows_follow_local_hours(self):
+        scheduler = UploadScheduler(parse_windows('1-2=1K,3=2K'), clock=SimulatedClock(0))
+        now = time.mktime((2026, 1, 1, 1, 10, 0, 0, 0, -1))
+        self.assertEqual(time.localtime(scheduler.get_window_end(now))[3:5], (4, 0))
+        self.assertEqual(scheduler.get_capacity(now, now + 7200), 6600 * 2**10 + 600 * 2**11)
+
+        scheduler.clock.now = time.mktime((2026, 1, 1, 23, 40, 0, 0, 0, -1))
+        scheduler.wait_for_window()
+        self.assertEqual(time.localtime(scheduler.clock.time())[3:5], (1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+from contextlib import contextmanager
+import json
+import logging
+import os
+import sqlite3
+import stat
+import threading
+
+
+# Reads the source with os.scandir, so each entry's type comes with the listing and its stat is taken at most once
+# on its way through sizing and planning. Every metadata call made on the source is counted.
+# Given a path, the listings on the way to the checkpoint are saved there, so a restart finds its way back with a
+# stat of each directory rather than listing them again.
+class Traversal:
+
+    def __init__(self, path=None):
+        self.path = path
+        self.connection = None
+        self.saved = {}
+        self.listings = {}
+        self.chain = []
+        self.pinned = None
+        self.subtree = set()
+        self.checked = set()
+        self.syscalls = 0
+        self.lock = threading.Lock()
+        if path is not None:
+            self.load()
+
+    # Take up the listings saved by the last run, which are checked against a stat like any other before use
+    def load(self):
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS listings (path TEXT PRIMARY KEY, inode INTEGER NOT NULL, "
+                                "mtime INTEGER NOT NULL, kinds TEXT NOT NULL)")
+        self.connection.commit()
+        for path, inode, mtime, kinds in self.connection.execute("SELECT path, inode, mtime, kinds FROM listings"):
+            self.listings[path] = Listing(inode, mtime, kinds=json.loads(kinds))
+            self.saved[path] = (inode, mtime)
+        self.chain = sorted(self.listings, key=len)
+        logging.debug(f"{self}: loaded {len(self.listings)} listings from {self.path}")
+
+    # Save the listings of the directories holding the checkpoint, writing only those that changed since last saved
+    def save(self, checkpoint):
+        if self.connection is None:
+            return
+        levels = {x: self.listings[x] for x in self.chain if checkpoint.startswith(os.path.join(x, ''))}
+        for path in [x for x in self.saved if x not in levels]:
+            self.connection.execute("DELETE FROM listings WHERE path = ?", (path,))
+            del self.saved[path]
+        for path, listing in levels.items():
+            if self.saved.get(path) != (listing.inode, listing.mtime):
+                kinds = json.dumps({x: listing.get_kind(x) for x in listing.names})
+                self.connection.execute("INSERT OR REPLACE INTO listings (path, inode, mtime, kinds) "
+                                        "VALUES (?, ?, ?, ?)", (path, listing.inode, listing.mtime, kinds))
+                self.saved[path] = (listing.inode, listing.mtime)
+        self.connection.commit()
+
+    # Count metadata calls made on the source, which other threads such as the size scanner also do
+    def count(self, calls=1):
+        with self.lock:
+            self.syscalls += calls
+
+    # Keep every listing below path while the block runs, so a subtree walked twice, first to read its files ahead
+    # and then to archive it, is only listed and stated once. A path of None keeps nothing more.
+    # The walk is done with the subtree when the block ends, so its listings are dropped then.
+    @contextmanager
+    def pin(self, path):
+        self.pinned = None if path is None else os.path.join(path, '')
+        try:
+            yield
+        finally:
+            self.pinned = None
+            self.checked = set()
+            for subtree_path in self.subtree:
+                del self.listings[subtree_path]
+            self.subtree = set()
+
+    # Return the sorted names in dir_path, listing it again only if it has changed since it was last listed
+    # Outside a pinned subtree, listings are kept as a chain of one directory for each level, outermost first.
+    # Listing a directory drops the end of the chain that is neither above nor below it, which is the only part
+    # that can be, as every directory in the chain is above or below the ones after it.
+    def list(self, dir_path):
+        prefix = os.path.join(dir_path, '')
+        if not self.is_pinned(dir_path):
+            while self.chain and not is_related(prefix, os.path.join(self.chain[-1], '')):
+                del self.listings[self.chain.pop()]
+
+        # A listing already held is checked against a fresh stat, unless it was listed or checked in this same
+        # pinned walk. A new one can use the stat from its parent.
+        listing = self.listings.get(dir_path)
+        if listing is not None and dir_path in self.checked:
+            return listing.names
+        if self.is_pinned(dir_path):
+            self.checked.add(dir_path)
+        if listing is not None:
+            self.count()
+            dir_stat = os.stat(dir_path)
+            if (listing.inode, listing.mtime) == (dir_stat.st_ino, dir_stat.st_mtime_ns):
+                return listing.names
+            logging.debug(f"{self}: {dir_path} has changed since it was listed")
+        else:
+            dir_stat = self.lstat(dir_path)
+
+        self.count()
+        with os.scandir(dir_path) as entries:
+            listing = Listing(dir_stat.st_ino, dir_stat.st_mtime_ns, entries)
+        if dir_path not in self.listings:
+            if self.is_pinned(dir_path):
+                self.subtree.add(dir_path)
+            else:
+                index = 0
+                while index < len(self.chain) and prefix.startswith(os.path.join(self.chain[index], '')):
+                    index += 1
+                self.chain.insert(index, dir_path)
+        self.listings[dir_path] = listing
+        return listing.names
+
+    # Return the stat of path without following links, taken from its directory's listing when that is held
+    def lstat(self, path):
+        listing, name = self.get_listing(path)
+        if listing is None:
+            self.count()
+            return os.lstat(path)
+        if name not in listing.stats:
+            self.count()
+            entry = listing.entries.get(name)
+            listing.stats[name] = os.lstat(path) if entry is None else entry.stat(follow_symlinks=False)
+        return listing.stats[name]
+
+    # Types come from the listing without a call, links are neither directories nor files
+    def is_dir(self, path):
+        listing, name = self.get_listing(path)
+        if listing is None:
+            return stat.S_ISDIR(self.lstat(path).st_mode)
+        return listing.get_kind(name) == 'd'
+
+    def is_file(self, path):
+        listing, name = self.get_listing(path)
+        if listing is None:
+            return stat.S_ISREG(self.lstat(path).st_mode)
+        return listing.get_kind(name) == 'f'
+
+    def is_pinned(self, path):
+        return self.pinned is not None and os.path.join(path, '').startswith(self.pinned)
+
+    # Return the listing held for the directory of path and the name of path, or None if path is not in it
+    def get_listing(self, path):
+        directory, name = os.path.split(path)
+        listing = self.listings.get(directory)
+        if listing is None or name not in listing:
+            return None, name
+        return listing, name
+
+    def __str__(self):
+        return f"Traversal {self.syscalls} calls"
+
+
+# True if one of two directory paths, each ending in a separator, is inside the other
+def is_related(prefix, other):
+    return prefix.startswith(other) or other.startswith(prefix)
+
+
+# The entries of a directory by name in sorted order, with the stats taken of them so far
+# A listing saved by an earlier run has the kind of each entry but not the entries themselves
+class Listing:
+
+    def __init__(self, inode, mtime, entries=None, kinds=None):
+        self.inode = inode
+        self.mtime = mtime
+        self.entries = {} if entries is None else {x.name: x for x in entries}
+        self.kinds = {} if kinds is None else kinds
+        self.names = sorted(self.kinds if entries is None else self.entries)
+        self.stats = {}
+
+    def __contains__(self, name):
+        return name in self.entries or name in self.kinds
+
+    # Return d for a directory, f for a regular file and o for anything else, taken from the entry's type
+    def get_kind(self, name):
+        if name not in self.kinds:
+            entry = self.entries[name]
+            if entry.is_dir(follow_symlinks=False):
+                self.kinds[name] = 'd'
+            else:
+                self.kinds[name] = 'f' if entry.is_file(follow_symlinks=False) else 'o'
+        return self.kinds[name]
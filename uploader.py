@@ -1,15 +1,29 @@
 import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import logging
 import logging.handlers
 import os
 import subprocess
-import time
 
-from common import get_size, get_smtp_handler, report
+from checksums import remove_checksums, verify_checksum
+from common import convert_tgmk, copy_stream, get_smtp_handler, get_temp_file_name, report
+from metrics import get_status, STAGE_QUEUES, StageTimer
+from multipart import get_backend, get_remaining_size, MultipartUpload
+from scheduler import parse_windows, UploadScheduler
+
+BUCKET = 's3://prometheus-backup-bucket'
 
 parser = argparse.ArgumentParser(description='Upload files to AWS.')
 parser.add_argument('working_dir', type=os.path.abspath, help='archiver working directory')
 parser.add_argument('--source', default="gpg", help='source folder name')
+parser.add_argument('--bucket', default=BUCKET, help='upload destination, an S3 url or a local directory')
+parser.add_argument('-j', '--jobs', default=1, type=int, help='number of files to upload at once')
+parser.add_argument('--part-jobs', default=4, type=int, help='number of parts of each file to upload at once')
+parser.add_argument('--part-size', default='64M', type=convert_tgmk,
+                    help='size of each part of a multipart upload (K, M, G, P supported)')
+parser.add_argument('--hours', default='0-6,20-23',
+                    help='hours of the day in which uploads may run, each with an optional limit in bytes per second '
+                         '(K, M, G, P supported), such as 0-6=200M,20-23')
 parser.add_argument('-d', '--debug', action='store_true', help='enable debug logging')
 
 
@@ -27,26 +41,22 @@ def main():
     else:
         logging.getLogger().addHandler(get_smtp_handler())
 
-    program_start = time.time()
+    # Upload progress is kept here so an interrupted upload resumes in the next run
+    state_dir = os.path.join(args.working_dir, "uploads")
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
 
     try:
         logging.debug(f"uploader starting")
 
-        # Get the list of files in the gpg directory
-        archive_path = os.path.join(args.working_dir, args.source)
-        archive_list = [x for x in os.listdir(archive_path) if x.endswith('gpg')]
-
-        # Transfer the files
-        for archive in archive_list:
-            path = os.path.join(archive_path, archive)
-            size = get_size(path)
+        # Uploads run in the upload hours at each hour's rate, and files are picked by what can finish before they
+        # end. Where no rate is set, the upload speed measured recently is used to judge that.
+        speed = get_status(args.working_dir)['stages']['upload']['bytes_per_second']
+        scheduler = UploadScheduler(parse_windows(args.hours), speed)
 
-            upload(path)
-            report(args.working_dir, f"uploaded {archive} {size}")
-
-            # Quit after an hour so we do not transfer during business hours
-            if time.time() > program_start + 3000:
-                break
+        # Transfer the files in the gpg directory
+        backend = get_backend(args.bucket)
+        upload_all(args, backend, os.path.join(args.working_dir, args.source), state_dir, scheduler)
 
         logging.debug(f"uploader ending")
     except subprocess.CalledProcessError as e:
@@ -57,29 +67,129 @@ def main():
         exit(1)
 
 
-# Upload the specified file or raise an exception
-def upload(path):
-    logging.debug(f"Starting encryption of file {path}")
-
-    # Upload the file to aws
-    command = ['aws', 's3', 'cp', path, 's3://prometheus-backup-bucket', '--storage-class', 'DEEP_ARCHIVE', '--quiet']
-    try:
-        child = subprocess.Popen(command)
-        child.wait()
-
-        if child.returncode == 1:
-            raise Exception(f"command '{' '.join(command)}' failed with return code 1. Is there a network problem?")
-
-        elif child.returncode != 0:
-            raise Exception(f"command '{' '.join(command)}' failed with return code {child.returncode}")
-
-    except subprocess.CalledProcessError as e:
-        raise e
+# Upload files from archive_path until none are left or the upload window closes, choosing the next file each
+# time a job comes free. A file stopped part way by the end of the window is not picked again in this run.
+def upload_all(args, backend, archive_path, state_dir, scheduler):
+    running = {}
+    remaining = {}
+    stopped = set()
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        while scheduler.is_open():
+            waiting = [os.path.join(archive_path, x) for x in sorted(os.listdir(archive_path))
+                       if x.endswith(STAGE_QUEUES['upload'][1])]
+            waiting = [x for x in waiting if x not in running and x not in stopped]
+            if waiting and len(running) < args.jobs:
+                path = scheduler.choose(waiting, state_dir, sum(remaining[x] for x in running))
+                remaining[path] = get_remaining_size(path, state_dir)
+                running[path] = pool.submit(upload, args, backend, path, state_dir, scheduler)
+                continue
+            if not running:
+                break
 
-    # Delete the original file
+            done, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+            for path in [x for x, future in running.items() if future in done]:
+                running.pop(path).result()
+                if os.path.isfile(path):
+                    stopped.add(path)
+
+        # Uploads running when the window closes stop at their next part
+        for path, future in running.items():
+            future.result()
+            if os.path.isfile(path):
+                stopped.add(path)
+    if not scheduler.is_open():
+        logging.debug(f"uploader outside its upload hours with {len(stopped)} files part way")
+
+
+# Upload the specified file or raise an exception, leaving it in place if the end of the upload window stops it
+# part way. Without a scheduler the file is uploaded at full speed whatever the time.
+def upload(args, backend, path, state_dir, scheduler=None):
+    logging.debug(f"Starting upload of file {path}")
+    if scheduler is not None and not scheduler.is_open():
+        return
+
+    size = os.path.getsize(path)
+    name = os.path.basename(path)
+    timer = StageTimer('upload')
+
+    # The file must read as the encrypter wrote it, and the object must have the ETag its parts make
+    def verify(sha256, read_size):
+        verify_checksum(args.working_dir, path, sha256, read_size)
+
+    multipart_upload = MultipartUpload(backend, path, state_dir, args.part_size)
+    throttle = None if scheduler is None else scheduler.throttle
+    if not multipart_upload.run(args.part_jobs, verify=verify, throttle=throttle):
+        return
+    timer.add_cpu(multipart_upload.cpu)
+
+    # Delete the original file, and its checksums now the upload has been checked against them
     os.remove(path)
+    remove_checksums(args.working_dir, name)
+    report(args.working_dir, f"uploaded {name} {size}", {'gpg': -size}, timer.get_record(name, size, size))
     logging.debug(f"upload completed {path}")
 
 
+# Upload everything read from stream as name, returning the number of bytes sent or raising an exception
+# The destination is an S3 url or, for testing, a local directory. The optional verify function is called
+# once the stream ends and raises if the data should not be kept.
+def upload_stream(stream, name, destination=BUCKET, expected_size=None, verify=None):
+    logging.debug(f"Starting streamed upload of {name} to {destination}")
+    check_not_uploaded(name, destination)
+
+    # A local directory gets the object through a temporary file so it appears all at once, and linking it into
+    # place fails rather than replace an object that appeared in the meantime
+    if not destination.startswith('s3://'):
+        tmp_path = os.path.join(destination, f".{get_temp_file_name()}")
+        try:
+            with open(tmp_path, 'wb') as f:
+                size = copy_stream(stream, f)
+            if verify is not None:
+                verify()
+            os.link(tmp_path, os.path.join(destination, name))
+        finally:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+        logging.debug(f"upload completed {name}")
+        return size
+
+    # S3 only shows the object once the whole multipart upload has completed
+    command = ['aws', 's3', 'cp', '-', f"{destination.rstrip('/')}/{name}", '--storage-class', 'DEEP_ARCHIVE',
+               '--quiet']
+
+    # Streams over 50G need a size hint so the part size can be chosen
+    if expected_size is not None:
+        command += ['--expected-size', str(expected_size)]
+    child = subprocess.Popen(command, stdin=subprocess.PIPE)
+    try:
+        size = copy_stream(stream, child.stdin)
+        if verify is not None:
+            verify()
+    # Kill rather than close the upload so an incomplete stream never becomes an object
+    except BaseException:
+        child.kill()
+        child.wait()
+        raise
+    child.stdin.close()
+    child.wait()
+    if child.returncode != 0:
+        raise Exception(f"command '{' '.join(command)}' failed with return code {child.returncode}")
+
+    logging.debug(f"upload completed {name}")
+    return size
+
+
+# Raise if the destination already holds an object called name, so an upload never replaces an earlier one
+def check_not_uploaded(name, destination=BUCKET):
+    if destination.startswith('s3://'):
+        bucket, _, prefix = destination[len('s3://'):].partition('/')
+        key = f"{prefix.rstrip('/')}/{name}" if prefix else name
+        exists = subprocess.run(['aws', 's3api', 'head-object', '--bucket', bucket, '--key', key],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+    else:
+        exists = os.path.exists(os.path.join(destination, name))
+    if exists:
+        raise FileExistsError(f"{name} is already at {destination}")
+
+
 if __name__ == '__main__':
     main()